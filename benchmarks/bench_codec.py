@@ -0,0 +1,113 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Benchmark the JSON codec on typical Plazi records.
+
+Usage::
+
+    python benchmarks/bench_codec.py [--records 1000] [--repeat 5]
+
+Encodes and decodes a batch of records shaped like the ``input_metadata`` of
+a Plazi treatment figure (creators, Darwin Core custom fields, related
+identifiers with lazy references) with every available backend.
+"""
+
+import argparse
+import json
+import timeit
+from datetime import datetime
+
+from lycophron import codec
+from lycophron.template import LazyReference
+
+
+def plazi_record(i):
+    """Build the input metadata of a typical Plazi figure record."""
+    return {
+        "metadata": {
+            "title": f"FIGURE {i}. Nycteris thebaica, habitus in lateral view",
+            "publication_date": "2023-05-17",
+            "resource_type": {"id": "image-figure"},
+            "description": "Specimen photographed in situ. " * 20,
+            "creators": [
+                {
+                    "person_or_org": {
+                        "type": "personal",
+                        "given_name": f"Given{j}",
+                        "family_name": f"Família{j}",
+                    },
+                    "affiliations": [{"name": "Muséum national d'Histoire naturelle"}],
+                }
+                for j in range(4)
+            ],
+            "related_identifiers": [
+                {
+                    "identifier": LazyReference(f"treatment{i}", "doi"),
+                    "relation_type": {"id": "ispartof"},
+                },
+                {
+                    "identifier": f"http://treatment.plazi.org/id/{i:032X}",
+                    "relation_type": {"id": "cites"},
+                },
+            ],
+            "subjects": [{"subject": s} for s in ("Biodiversity", "Taxonomy")],
+        },
+        "custom_fields": {
+            "dwc:kingdom": ["Animalia"],
+            "dwc:phylum": ["Chordata"],
+            "dwc:class": ["Mammalia"],
+            "dwc:order": ["Chiroptera"],
+            "dwc:family": ["Nycteridae"],
+            "dwc:genus": ["Nycteris"],
+            "dwc:specificEpithet": ["thebaica"],
+            "dwc:decimalLatitude": ["14.7167"],
+            "dwc:decimalLongitude": ["-17.4677"],
+        },
+        "access": {"record": "public", "files": "public"},
+        "loaded": datetime(2023, 5, 17, 10, 30, i % 60),
+    }
+
+
+def backends():
+    """Yield the available encoders and decoders by name."""
+    yield (
+        "json (stdlib)",
+        lambda obj: json.dumps(obj, default=codec.default, ensure_ascii=False),
+        json.loads,
+    )
+    if codec.orjson is not None:
+        yield "orjson", codec.dumps, codec.orjson.loads
+
+
+def best_of(fn, items, repeat):
+    """Return the fastest time, in seconds, of applying ``fn`` to all items."""
+    return min(timeit.repeat(lambda: [fn(i) for i in items], number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    records = [plazi_record(i) for i in range(args.records)]
+    size = sum(len(codec.dumps_bytes(r)) for r in records)
+    print(
+        f"{args.records} records, {size / args.records:.0f} bytes per record, "
+        f"active backend: {codec.BACKEND}"
+    )
+    print(f"{'backend':<16}{'encode rec/s':>14}{'decode rec/s':>14}{'MB/s enc':>10}")
+    for name, encode, decode in backends():
+        encoded = [encode(r) for r in records]
+        t_enc = best_of(encode, records, args.repeat)
+        t_dec = best_of(decode, encoded, args.repeat)
+        print(
+            f"{name:<16}{args.records / t_enc:>14,.0f}{args.records / t_dec:>14,.0f}"
+            f"{size / t_enc / 1e6:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
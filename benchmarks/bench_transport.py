@@ -0,0 +1,149 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Benchmark the HTTP transport of the client against a local HTTPS server.
+
+Usage::
+
+    python benchmarks/bench_transport.py [--threads 16] [--requests 2000]
+
+Starts an HTTPS stand-in of Zenodo with a self-signed certificate (created
+with the ``openssl`` command), then sends ``--requests`` GETs from
+``--threads`` threads sharing a session, like the threads of a worker. The
+certificate is verified in all cases. Compares:
+
+- ``per-request``: a new connection, and TLS handshake, for every request
+- ``default``: a default ``requests`` session, whose pool keeps 10 connections
+- ``tuned``: a session set up by `client.mount_transport`, as the app does
+
+and reports the requests per second and the TLS handshakes of each.
+"""
+
+import argparse
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from lycophron.client import mount_transport
+
+BODY = b'{"id": "abcd-1234", "status": "draft"}'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Returns a small JSON body, keeping connections alive."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+
+class HTTPSServer(ThreadingHTTPServer):
+    """Counts the TLS handshakes, i.e. the connections accepted."""
+
+    daemon_threads = True
+
+    def __init__(self, address, context):
+        super().__init__(address, Handler)
+        self.context = context
+        self.handshakes = 0
+
+    def get_request(self):
+        sock, address = super().get_request()
+        self.handshakes += 1
+        return self.context.wrap_socket(sock, server_side=True), address
+
+
+def create_certificate(tmpdir):
+    """Create a self-signed certificate for localhost."""
+    cert = os.path.join(tmpdir, "cert.pem")
+    key = os.path.join(tmpdir, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost",
+            "-keyout",
+            key,
+            "-out",
+            cert,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+def run(name, url, cert, args, server):
+    """Send the requests with a transport and report its figures."""
+    if name == "per-request":
+
+        def get():
+            requests.get(url, verify=cert, timeout=10).raise_for_status()
+
+    else:
+        session = requests.Session()
+        if name == "tuned":
+            mount_transport(session, pool_size=args.threads, retries=3)
+
+        def get():
+            session.get(url, verify=cert, timeout=10).raise_for_status()
+
+    server.handshakes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        for future in [pool.submit(get) for _ in range(args.requests)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:>12}: {args.requests / elapsed:8.0f} requests/s "
+        f"{server.handshakes:6} TLS handshakes"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cert, key = create_certificate(tmpdir)
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cert, key)
+        server = HTTPSServer(("localhost", 0), context)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"https://localhost:{server.server_address[1]}/api/records/1"
+
+        for name in ["per-request", "default", "tuned"]:
+            run(name, url, cert, args, server)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Benchmark the memory and throughput of file uploads.
+
+Usage::
+
+    python benchmarks/bench_upload.py [--size-mib 4096] [--chunk-kib 1024]
+        [--read-ahead 4]
+
+Writes a file of ``--size-mib`` MiB (pick more than the RAM of the machine to
+check that uploads do not depend on it), uploads it to a local server that
+discards the body, and reports the disk-to-socket throughput and the memory
+of the process along the way. The memory reported is the anonymous memory,
+the pages of the file mapped while sending a chunk being page cache. Exits
+with status 1 if it grows by more than ``--max-growth`` MiB.
+
+Compare ``--read-ahead 0`` with the default on slow (e.g. network) storage,
+after dropping the page cache, to see the disk and the network overlap.
+Pass ``--sparse`` to create the file without writing it, e.g. to check the
+memory with a file larger than the free disk space.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from lycophron.streams import FileStream
+
+
+def anon_mib():
+    """Return the anonymous resident memory of the process in MiB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class DiscardHandler(BaseHTTPRequestHandler):
+    """Reads the request body and throws it away."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_PUT(self):
+        remaining = int(self.headers["Content-Length"])
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def write_file(path, size, sparse):
+    """Write a file of the given size, in MiB."""
+    with open(path, "wb") as f:
+        if sparse:
+            f.truncate(size * 2**20)
+            return
+        block = os.urandom(2**20)
+        f.writelines(block for _ in range(size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mib", type=int, default=4096)
+    parser.add_argument("--chunk-kib", type=int, default=1024)
+    parser.add_argument("--read-ahead", type=int, default=4)
+    parser.add_argument("--max-growth", type=float, default=20.0)
+    parser.add_argument("--sparse", action="store_true")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DiscardHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/content"
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "data.bin")
+        print(f"Writing {args.size_mib} MiB to {path}", flush=True)
+        write_file(path, args.size_mib, args.sparse)
+
+        samples = []
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.2):
+                samples.append(anon_mib())
+
+        baseline = anon_mib()
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        start = time.perf_counter()
+        with (
+            requests.Session() as session,
+            FileStream(
+                path, chunk_size=args.chunk_kib * 1024, read_ahead=args.read_ahead
+            ) as stream,
+        ):
+            session.put(url, data=stream).raise_for_status()
+        elapsed = time.perf_counter() - start
+        done.set()
+        sampler.join()
+
+    server.shutdown()
+    peak = max(samples, default=anon_mib())
+    print(f"Uploaded {args.size_mib} MiB in {elapsed:.1f} s")
+    print(f"Throughput: {args.size_mib / elapsed:.1f} MiB/s")
+    print(f"Anonymous memory: {baseline:.1f} MiB before, {peak:.1f} MiB peak")
+    sys.exit(1 if peak - baseline > args.max_growth else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Soak test of the worker memory while processing records.
+
+Usage::
+
+    python benchmarks/soak_session.py [--records 100000] [--threads 4]
+
+Creates a throw-away project, publishes every record against an in-memory
+stand-in of the InvenioRDM client from a pool of long-lived threads (like the
+Celery thread pool) and reports the resident memory along the way. Exits with
+status 1 if the memory grows by more than ``--max-growth`` MiB after warm-up.
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+from sqlalchemy import insert
+
+
+def rss_mib():
+    """Return the resident set size of the process in MiB."""
+    try:
+        import psutil
+    except ImportError:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    return psutil.Process().memory_info().rss / 2**20
+
+
+class FakeResource:
+    """Stand-in for the draft, files and record resources of the client."""
+
+    _ids = count()
+
+    def __init__(self, data=None):
+        self.data = data or {}
+
+    def create(self, data=None):
+        return FakeResource({"id": str(next(self._ids)), "status": "draft"})
+
+    def update(self, data=None):
+        return FakeResource({"id": "1", "metadata": {}})
+
+    def publish(self):
+        return FakeResource({"id": "1", "status": "published"})
+
+    @property
+    def draft(self):
+        return self
+
+    def __call__(self, *args):
+        return self
+
+
+class FakeClient:
+    records = FakeResource()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--max-growth", type=float, default=20.0)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+
+    from lycophron.app import LycophronApp
+    from lycophron.models import Record, RecordStatus
+    from lycophron.tasks.tasks import process_record
+
+    app = LycophronApp()
+    app.init()
+    app.client = FakeClient()
+    db = app.project.db
+    ids = [f"record{i}" for i in range(args.records)]
+    metadata = {"metadata": {"title": "Soak", "description": "x" * 2000}}
+    with db.task_scope() as session:
+        session.execute(
+            insert(Record),
+            [
+                {
+                    "id": record_id,
+                    "input_metadata": metadata,
+                    "status": RecordStatus.QUEUED,
+                }
+                for record_id in ids
+            ],
+        )
+        session.commit()
+
+    processed = count(1)
+    samples = []
+    lock = threading.Lock()
+    step = max(args.records // 10, 1)
+
+    def work(record_id):
+        # Call the task function directly, as the executors do: the task's
+        # __call__ is not safe from several threads
+        process_record.run(record_id)
+        n = next(processed)
+        if n % step == 0:
+            with lock:
+                gc.collect()
+                samples.append((n, rss_mib()))
+                print(f"{n:>9} records  {samples[-1][1]:8.1f} MiB", flush=True)
+
+    # Submit the records as threads free up, a backlog of pending futures
+    # would shrink along the run and hide the growth of the workers
+    slots = threading.BoundedSemaphore(args.threads * 2)
+    errors = []
+
+    def done(future):
+        if future.exception():
+            errors.append(future.exception())
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        for record_id in ids:
+            slots.acquire()
+            pool.submit(work, record_id).add_done_callback(done)
+    if errors:
+        raise errors[0]
+
+    summary = app.project.status_summary()
+    print(f"Published: {summary['records']['PUBLISHED']} of {args.records}")
+    # Ignore the first sample, taken while caches and pools warm up
+    growth = samples[-1][1] - samples[min(1, len(samples) - 1)][1]
+    print(f"RSS growth after warm-up: {growth:+.1f} MiB")
+    sys.exit(1 if growth > args.max_growth else 0)
+
+
+if __name__ == "__main__":
+    main()
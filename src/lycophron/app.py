@@ -11,10 +11,14 @@ from functools import cached_property
 
 from inveniordm_py import InvenioAPI
 
-from .client import create_session
+from .bandwidth import BandwidthLimiter
+from .breaker import CircuitBreaker
+from .client import RateLimitedSession, create_session, mount_transport, ssl_verify
+from .concurrency import AdaptiveChunkSize, ConcurrencyController
 from .config import Config
 from .errors import InvalidConfig, InvalidDirectoryError
 from .project import Project
+from .ratelimit import RateLimiter
 
 
 class SingletonMeta(type):
@@ -46,6 +50,11 @@ class LycophronApp(metaclass=SingletonMeta):
         """Get the root path of the project."""
         return os.path.join(os.getcwd(), self.name)
 
+    @property
+    def workers_file(self):
+        """Get the path of the file flagging that `start` is running."""
+        return os.path.join(self.root_path, ".workers.pid")
+
     @cached_property
     def config(self):
         """Get the config."""
@@ -64,11 +73,88 @@ class LycophronApp(metaclass=SingletonMeta):
     @cached_property
     def client(self):
         """Get the client."""
-        client = InvenioAPI(
-            base_url=self.config["ZENODO_URL"], access_token=self.config["TOKEN"]
+        config = self.config
+        session = RateLimitedSession(
+            self.rate_limiter,
+            timeout=(config["HTTP_CONNECT_TIMEOUT"], config["HTTP_READ_TIMEOUT"]),
+        )
+        if config["HTTP_TRANSPORT"] == "httpx":
+            from .transport import mount_http2_transport
+
+            mount = mount_http2_transport
+        elif config["HTTP_TRANSPORT"] == "requests":
+            mount = mount_transport
+        else:
+            raise InvalidConfig(key="HTTP_TRANSPORT", value=config["HTTP_TRANSPORT"])
+        mount(session, pool_size=self.http_pool_size, retries=config["HTTP_RETRIES"])
+        session.verify = ssl_verify(config["ZENODO_URL"], config["SSL_VERIFY"])
+        return InvenioAPI(
+            base_url=config["ZENODO_URL"],
+            access_token=config["TOKEN"],
+            session=session,
+        )
+
+    @property
+    def http_pool_size(self):
+        """Get the number of connections kept alive to Zenodo.
+
+        Defaults to the most threads sending requests at the same time in a
+        worker, i.e. the files stage uploading several files per record.
+        """
+        if self.config["HTTP_POOL_SIZE"]:
+            return self.config["HTTP_POOL_SIZE"]
+        limits = self.config["CONCURRENCY_LIMITS"]
+        uploads = limits.get("files", 1) * self.config["FILE_UPLOAD_CONCURRENCY"]
+        return max([*limits.values(), uploads])
+
+    @cached_property
+    def rate_limiter(self):
+        """Get the rate limiter of the requests sent to Zenodo."""
+        # The worker processes of the project share the budget through the
+        # state files
+        return RateLimiter(
+            self.config["RATE_LIMIT"],
+            state_path=os.path.join(self.root_path, ".ratelimit"),
+            # The 429 responses retried by the session lower the concurrency
+            on_throttle=self.concurrency.throttled,
+        )
+
+    @cached_property
+    def breaker(self):
+        """Get the circuit breaker of the calls to Zenodo."""
+        return CircuitBreaker(
+            threshold=self.config["BREAKER_THRESHOLD"],
+            min_calls=self.config["BREAKER_MIN_CALLS"],
+            cooldown=self.config["BREAKER_COOLDOWN"],
+            state_path=os.path.join(self.root_path, ".breaker"),
+        )
+
+    @cached_property
+    def upload_bandwidth(self):
+        """Get the bandwidth limiter shared by all the uploads."""
+        return BandwidthLimiter(self.config["UPLOAD_BANDWIDTH"])
+
+    @cached_property
+    def stage_rate_limiters(self):
+        """Get the rate limiters of the stages that have a rate budget."""
+        return {
+            stage: RateLimiter(rate)
+            for stage, rate in self.config["STAGE_RATE_LIMITS"].items()
+        }
+
+    @cached_property
+    def concurrency(self):
+        """Get the adaptive concurrency limits of the publishing stages."""
+        return ConcurrencyController(self.config["CONCURRENCY_LIMITS"])
+
+    @cached_property
+    def chunk_size(self):
+        """Get the adaptive number of records sent in each task."""
+        return AdaptiveChunkSize(
+            target=self.config["CHUNK_DURATION"],
+            max_size=self.config["CHUNK_MAX_SIZE"],
+            state_path=os.path.join(self.root_path, ".chunks"),
         )
-        client.session.verify = False
-        return client
 
     @cached_property
     def project(self):
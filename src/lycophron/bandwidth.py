@@ -0,0 +1,126 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Shaping of the upload traffic: bandwidth caps and restricted hours."""
+
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .errors import InvalidConfig
+
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+_WINDOW = re.compile(
+    r"^(?:(?P<days>[a-z,\-]+)\s+)?(?P<start>\d{1,2}:\d{2})-(?P<end>\d{1,2}:\d{2})$"
+)
+
+
+class BandwidthLimiter:
+    """Token bucket of bytes per second, shared by the threads uploading.
+
+    ``consume`` returns once the bytes can be sent, waiting if the bucket is
+    empty. The rate can be changed at any time, 0 means unlimited.
+    """
+
+    def __init__(self, rate=0, burst=1.0):
+        self.rate = rate
+        # Seconds of traffic that can be sent at once after being idle
+        self.burst = burst
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        """Wait until ``n`` more bytes can be sent."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            capacity = self.rate * self.burst
+            self._tokens = min(
+                capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # Chunks larger than the bucket are let through on credit, the
+            # next ones waiting until it is paid back
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def _parse_time(value):
+    hours, minutes = (int(part) for part in value.split(":"))
+    if not (0 <= hours <= 24 and 0 <= minutes < 60) or hours * 60 + minutes > 1440:
+        raise ValueError(value)
+    return hours * 60 + minutes
+
+
+def _parse_days(value):
+    days = set()
+    for item in value.split(","):
+        first, _, last = item.partition("-")
+        start = DAYS.index(first)
+        end = DAYS.index(last) if last else start
+        days.update(day % 7 for day in range(start, end + 7 * (end < start) + 1))
+    return days
+
+
+def parse_window(spec):
+    """Parse a window such as ``"08:00-18:00"`` or ``"mon-fri 08:00-18:00"``.
+
+    Windows ending before they start span midnight, e.g. ``"22:00-06:00"``.
+
+    :return: the weekdays (0 is Monday), start and end minutes of the window
+    """
+    match = _WINDOW.match(spec.strip().lower())
+    try:
+        if not match:
+            raise ValueError(spec)
+        days = _parse_days(match["days"]) if match["days"] else set(range(7))
+        return days, _parse_time(match["start"]), _parse_time(match["end"])
+    except ValueError:
+        raise InvalidConfig(key="UPLOAD_RESTRICTED_HOURS", value=spec) from None
+
+
+def _current_window_end(window, now):
+    """Return the end of the window if ``now`` is within it, else None."""
+    days, start, end = window
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    minute = now.hour * 60 + now.minute + now.second / 60
+    weekday = now.weekday()
+    if start <= end:
+        if weekday in days and start <= minute < end:
+            return midnight + timedelta(minutes=end)
+        return None
+    # Spanning midnight, started today or yesterday
+    if weekday in days and minute >= start:
+        return midnight + timedelta(days=1, minutes=end)
+    if (weekday - 1) % 7 in days and minute < end:
+        return midnight + timedelta(minutes=end)
+    return None
+
+
+def restricted_until(specs, now=None):
+    """Return when the restricted window we are in ends, None if we are not.
+
+    Consecutive or overlapping windows are merged.
+
+    :param specs: windows, see `parse_window`, in local time
+    :param now: aware datetime, defaults to the current local time
+    """
+    windows = [parse_window(spec) for spec in specs]
+    now = now or datetime.now().astimezone()
+    until = None
+    # A week of windows at most, e.g. restricted all the time
+    for _ in range(len(windows) * 7):
+        ends = [_current_window_end(w, until or now) for w in windows]
+        ends = [end for end in ends if end is not None]
+        if not ends:
+            break
+        until = max(ends)
+    return until
@@ -0,0 +1,117 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Circuit breaker pausing the publication while Zenodo is unavailable."""
+
+import enum
+import json
+import threading
+import time
+from collections import deque
+
+from .retries import is_outage
+from .state import StateFile
+
+
+class BreakerState(str, enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Stops calling Zenodo once too many calls fail because of an outage.
+
+    The breaker opens when at least ``threshold`` of the last ``window`` calls
+    (and at least ``min_calls``) failed with an outage error, see
+    `retries.is_outage`. No calls go through for ``cooldown`` seconds, then a
+    single probe is let through (half-open): it closes the breaker if it
+    succeeds, or opens it for another ``cooldown`` otherwise.
+
+    The state is written to ``state_path`` so that all the processes of the
+    project, e.g. the dispatcher, follow it.
+    """
+
+    def __init__(
+        self, threshold=0.5, window=20, min_calls=10, cooldown=30, state_path=None
+    ):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.state_path = state_path
+        self._outcomes = deque(maxlen=window)
+        self._open = False
+        # Wall clock time, so that it can be shared with other processes
+        self._open_until = 0.0
+        self._probing = False
+        self._state = StateFile(state_path, loads=json.loads, dumps=json.dumps)
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> BreakerState:
+        """Current state of the breaker."""
+        self._read_state()
+        if not self._open:
+            return BreakerState.CLOSED
+        if time.time() < self._open_until:
+            return BreakerState.OPEN
+        return BreakerState.HALF_OPEN
+
+    def retry_after(self) -> float:
+        """Return the seconds left before calls can be attempted again."""
+        return max(self._open_until - time.time(), 0.0) if self._open else 0.0
+
+    def allow(self) -> bool:
+        """Whether a call can go through, taking the probe slot if half-open."""
+        with self._lock:
+            state = self.state
+            if state == BreakerState.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return state != BreakerState.OPEN
+
+    def record(self, error=None) -> bool:
+        """Record the outcome of a call that was allowed.
+
+        :param error: the error raised by the call, if any
+        :return: whether the call closed the breaker
+        :rtype: bool
+        """
+        failed = error is not None and is_outage(error)
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                if failed:
+                    self._trip()
+                    return False
+                self._reset()
+                return True
+            self._outcomes.append(failed)
+            if len(self._outcomes) >= self.min_calls and sum(
+                self._outcomes
+            ) >= self.threshold * len(self._outcomes):
+                self._trip()
+            return False
+
+    def _trip(self):
+        self._open = True
+        self._open_until = time.time() + self.cooldown
+        self._outcomes.clear()
+        self._write_state()
+
+    def _reset(self):
+        self._open = False
+        self._outcomes.clear()
+        self._write_state()
+
+    def _read_state(self):
+        state = self._state.read()
+        if state is not None:
+            self._open = state.get("open", False)
+            self._open_until = state.get("until", 0.0)
+
+    def _write_state(self):
+        self._state.write({"open": self._open, "until": self._open_until})
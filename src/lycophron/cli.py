@@ -6,6 +6,8 @@
 """Lycophron cli tools."""
 
 import csv
+import json
+import os
 import signal
 import subprocess
 import sys
@@ -18,6 +20,7 @@ import click
 
 from .app import LycophronApp
 from .logger import logger
+from .models import RecordStatus
 
 INFO_COLOR = "cyan"
 
@@ -62,6 +65,18 @@ def init(pname=None, token=None):
     click.secho(f"Project initialized in directory {app.root_path}.", fg="green")
 
 
+def _notify_workers(app):
+    """Ask the running workers, if any, to dispatch the records now."""
+    if not os.path.exists(app.workers_file):
+        return
+    from .tasks.tasks import request_dispatch
+
+    try:
+        request_dispatch()
+    except Exception as e:
+        logger.warning(f"Could not notify the workers: {e}")
+
+
 @lycophron.command()
 @click.option("--file", required=True)
 def load(file):
@@ -70,6 +85,7 @@ def load(file):
     logger.debug(f"Loading file {file}")
     try:
         app.load_file(file)
+        _notify_workers(app)
         click.echo(
             click.style(
                 "Loading finished. See messages above for results.", fg=INFO_COLOR
@@ -109,10 +125,37 @@ def export(file, all):
     click.echo(click.style(f"Exported data to {file.name}.", fg=INFO_COLOR))
 
 
+@lycophron.command()
+@click.option("--json", "as_json", is_flag=True, default=False, help="Output as JSON.")
+def status(as_json):
+    """Show the publishing progress of the project."""
+    app = LycophronApp()
+    try:
+        summary = app.project.status_summary()
+    except Exception as e:
+        click.secho(f"Failed to get project status: {e}", fg="red")
+        return
+    if as_json:
+        click.echo(json.dumps(summary, default=str))
+        return
+
+    click.secho(f"Records: {summary['total']}", fg=INFO_COLOR)
+    for name, count in summary["records"].items():
+        click.echo(f"  {name:<20} {count}")
+    click.secho("Files:", fg=INFO_COLOR)
+    for name, count in summary["files"].items():
+        click.echo(f"  {name:<20} {count}")
+    click.secho("Failures per stage:", fg=INFO_COLOR)
+    for stage, count in summary["failures"].items():
+        click.secho(f"  {stage:<20} {count}", fg="red" if count else None)
+    oldest = summary["oldest_pending"] or "-"
+    click.secho(f"Oldest pending update: {oldest}", fg=INFO_COLOR)
+
+
 @lycophron.command()
 def start():
-    """Starts the background worker for publishing records."""
-    click.secho("Starting Celery worker and beat scheduler...", fg=INFO_COLOR)
+    """Starts the background workers for publishing records."""
+    click.secho("Starting Celery workers and beat scheduler...", fg=INFO_COLOR)
 
     processes = []
 
@@ -131,6 +174,7 @@ def start():
                 proc.join(timeout=5)
                 if proc.is_alive():
                     proc.kill()
+        Path(app.workers_file).unlink(missing_ok=True)
         sys.exit(0)
 
     # Register signal handlers
@@ -139,22 +183,40 @@ def start():
     if hasattr(signal, "SIGBREAK"):  # Windows
         signal.signal(signal.SIGBREAK, signal_handler)
 
-    try:
-        # Start Celery worker process
-        worker_cmd = [
-            sys.executable,
-            "-m",
-            "celery",
-            "-A",
-            "lycophron.tasks",
-            "worker",
-            "--pool=threads",
-            "--loglevel=info",
-        ]
-        worker_process = subprocess.Popen(worker_cmd)
-        processes.append(worker_process)
+    from .tasks import STAGE_QUEUES
+    from .tasks.tasks import record_dispatcher
 
-        # Give worker time to start
+    app = LycophronApp()
+    # Upgrade the DB of a project from an older version before the workers,
+    # started together, open it
+    app.project.db.upgrade_schema()
+    limits = app.config["CONCURRENCY_LIMITS"]
+    # The default queue only receives the dispatcher, then one worker per stage
+    # with as many threads as the stage's concurrency limit
+    workers = [("default", "celery", 1)] + [
+        (queue, queue, limits.get(queue, 1)) for queue in STAGE_QUEUES.values()
+    ]
+
+    try:
+        # Start Celery worker processes
+        for name, queue, concurrency in workers:
+            worker_cmd = [
+                sys.executable,
+                "-m",
+                "celery",
+                "-A",
+                "lycophron.tasks",
+                "worker",
+                "--pool=threads",
+                f"--concurrency={concurrency}",
+                f"--queues={queue}",
+                f"--hostname={name}@%h",
+                "--loglevel=info",
+            ]
+            worker_process = subprocess.Popen(worker_cmd)
+            processes.append(worker_process)
+
+        # Give workers time to start
         time.sleep(2)
 
         # Start Celery beat process
@@ -170,8 +232,12 @@ def start():
         beat_process = subprocess.Popen(beat_cmd)
         processes.append(beat_process)
 
+        # Let other commands (e.g. `load`) trigger a dispatch while running
+        Path(app.workers_file).write_text(str(os.getpid()))
+        record_dispatcher.delay()
+
         click.secho(
-            "Celery worker and beat scheduler started successfully.", fg="green"
+            "Celery workers and beat scheduler started successfully.", fg="green"
         )
         click.secho("Press Ctrl+C to stop.", fg=INFO_COLOR)
 
@@ -189,6 +255,60 @@ def start():
         signal_handler(None, None)
 
 
+@lycophron.command()
+@click.option(
+    "--engine",
+    type=click.Choice(["threads"]),
+    default="threads",
+    show_default=True,
+    help="Scheduler used to process the records.",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of records processed at the same time.",
+)
+def publish(engine, concurrency):
+    """Publish the loaded records from this process, without a Celery worker."""
+    from .executors import EXECUTORS
+
+    app = LycophronApp()
+    executor = EXECUTORS[engine](app.project, concurrency=concurrency)
+
+    def drain_handler(signum, frame):
+        """Let the records in progress finish, abort on a second signal."""
+        click.secho(
+            "\nFinishing the records in progress, press Ctrl+C again to abort...",
+            fg="yellow",
+        )
+        executor.stop()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    signal.signal(signal.SIGINT, drain_handler)
+    click.secho(
+        f"Publishing records with the {engine} engine (concurrency: {concurrency})...",
+        fg=INFO_COLOR,
+    )
+    try:
+        n_records = executor.run()
+    except Exception as e:
+        click.secho(f"Error publishing records: {e}", fg="red")
+        return
+    finally:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    if executor.stopping:
+        click.secho("Publishing interrupted.", fg="yellow")
+    summary = app.project.status_summary()
+    click.secho(
+        f"{n_records} records processed. "
+        f"Published: {summary['records'][RecordStatus.PUBLISHED.value]}, "
+        f"failed: {sum(summary['failures'].values())}.",
+        fg=INFO_COLOR,
+    )
+
+
 @lycophron.command()
 @click.option("--file", required=True)
 @click.pass_context
@@ -347,18 +467,61 @@ def validate(file):
 
 
 @lycophron.command()
-def retry_failed():
+@click.option(
+    "--status",
+    "statuses",
+    multiple=True,
+    type=click.Choice(
+        sorted(status.value for status in RecordStatus.failed_statuses),
+        case_sensitive=False,
+    ),
+    help="Only retry records in this failed status. Can be repeated.",
+)
+@click.option("--error", help="Only retry records whose error contains this text.")
+@click.option(
+    "--http-status",
+    type=int,
+    help="Only retry records whose Zenodo response has this HTTP status.",
+)
+@click.option(
+    "--id", "ids", multiple=True, help="Only retry this record. Can be repeated."
+)
+def retry_failed(statuses, error, http_status, ids):
     """Set failed records to be retried."""
     app = LycophronApp()
     queued_records = 0
     try:
-        queued_records = app.project.retry_failed()
+        queued_records = app.project.retry_failed(
+            statuses=[RecordStatus(status) for status in statuses],
+            error=error,
+            http_status=http_status,
+            ids=ids or None,
+        )
     except Exception as e:
         click.secho(f"Failed to retry records: {e}", fg="red")
         return
+    _notify_workers(app)
     click.secho(f"{queued_records} records queued for retrying.", fg=INFO_COLOR)
 
 
+@lycophron.command()
+@click.confirmation_option(
+    prompt=(
+        "Responses of successful records will be trimmed according to "
+        "RESPONSE_RETENTION. Continue?"
+    )
+)
+def compact():
+    """Shrink the stored Zenodo responses."""
+    app = LycophronApp()
+    try:
+        n_records = app.project.compact_responses(app.config)
+    except Exception as e:
+        click.secho(f"Failed to compact responses: {e}", fg="red")
+        return
+    click.secho(f"{n_records} responses compacted.", fg=INFO_COLOR)
+
+
 @lycophron.command()
 def recreate():
     """Recreate the project."""
@@ -5,7 +5,15 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 """Lycophron requests wrapper."""
 
+from urllib.parse import urlparse
+
 import requests
+from inveniordm_py.records import metadata
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import codec
+from .logger import logger
 
 
 def create_session(token):
@@ -18,3 +26,88 @@ def create_session(token):
         }
     )
     return session
+
+
+class RateLimitedSession(requests.Session):
+    """Session sending every request through a `RateLimiter`.
+
+    Requests rejected with a 429 status are sent again once the limiter allows
+    it, up to ``max_retries`` times. Streamed bodies cannot be sent twice, so
+    those responses are returned as they are. Requests without a timeout get
+    ``timeout``, and the ``verify`` of the session, which ``requests`` would
+    otherwise replace with the ``REQUESTS_CA_BUNDLE`` environment variable.
+    """
+
+    def __init__(self, limiter, max_retries=5, timeout=None):
+        super().__init__()
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+    def request(self, method, url, *args, **kwargs):
+        """Send a request, waiting for the rate limiter first."""
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        if kwargs.get("verify") is None:
+            kwargs["verify"] = self.verify
+        data = kwargs.get("data")
+        retries = self.max_retries if isinstance(data, str | bytes | None) else 0
+        for attempt in range(retries + 1):
+            self.limiter.acquire()
+            response = super().request(method, url, *args, **kwargs)
+            self.limiter.update(response)
+            if response.status_code != 429 or attempt == retries:
+                return response
+            logger.warning(f"Rate limited on {method} {url}, retrying")
+            response.close()
+
+
+# Hosts of local instances, whose certificates are self-signed
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+# Server errors worth retrying for idempotent requests, rate limits being
+# handled by `RateLimitedSession`
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+# Methods of the requests retried on connection errors and server errors
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+def mount_transport(session, pool_size, retries=0, backoff_factor=0.5):
+    """Mount an HTTP adapter sized for the threads sharing the session.
+
+    Connections are kept alive in a pool of ``pool_size`` connections per host,
+    so that each thread reuses a connection, and its TLS session, instead of
+    opening a new one for every request. Idempotent requests are retried up to
+    ``retries`` times on connection errors and server errors.
+    """
+    max_retries = Retry(
+        total=retries,
+        allowed_methods=IDEMPOTENT_METHODS,
+        status_forcelist=RETRY_STATUS_CODES,
+        backoff_factor=backoff_factor,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=max_retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return adapter
+
+
+def ssl_verify(url, verify=None):
+    """Return how to verify the certificate of the given Zenodo URL.
+
+    :param verify: True, False or the path of a CA bundle; None verifies it
+        unless it is a local instance
+    """
+    if verify is not None:
+        return verify
+    return urlparse(url).hostname not in LOCAL_HOSTS
+
+
+class DraftMetadata(metadata.DraftMetadata):
+    """Draft metadata whose request body is encoded with `codec`."""
+
+    def to_request(self):
+        """Convert metadata to a UTF-8 JSON request body."""
+        return codec.dumps_bytes(self._data)
@@ -0,0 +1,85 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""JSON codec for DB columns and HTTP payloads.
+
+`orjson <https://github.com/ijl/orjson>`_ is used when installed (e.g. with
+``pip install lycophron[speedups]``), otherwise the standard library encoder.
+Both produce the same documents: UTF-8 text, ISO 8601 datetimes and
+`LazyReference` objects as ``lazy_reference`` dictionaries.
+"""
+
+import json
+from datetime import date, datetime
+
+from .template import LazyReference
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson else "json"
+
+
+def encode(obj):
+    """Encode the types that JSON does not know about, raise for the others."""
+    if isinstance(obj, LazyReference):
+        return {
+            "type": "lazy_reference",
+            "record_id": obj.record_id,
+            "field": obj.field,
+            "bidirectional": obj.bidirectional,
+        }
+    if isinstance(obj, datetime | date):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def default(obj):
+    """As `encode`, other types being encoded as strings, e.g. in DB columns."""
+    try:
+        return encode(obj)
+    except TypeError:
+        return str(obj)
+
+
+def _stdlib_dumps(obj, indent=False, default=default):
+    return json.dumps(
+        obj, default=default, ensure_ascii=False, indent=2 if indent else None
+    )
+
+
+def dumps(obj, indent=False, default=default) -> str:
+    """Serialize ``obj`` to a JSON string.
+
+    :param indent: pretty-print with an indentation of two spaces
+    :param default: encoder of the types that JSON does not know about, e.g.
+        `encode` to raise a TypeError for unsupported types
+    """
+    if orjson is None:
+        return _stdlib_dumps(obj, indent=indent, default=default)
+    return dumps_bytes(obj, indent=indent, default=default).decode()
+
+
+def dumps_bytes(obj, indent=False, default=default) -> bytes:
+    """Serialize ``obj`` to UTF-8 encoded JSON, e.g. for a request body."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except orjson.JSONEncodeError:
+            # E.g. integers over 64 bits, which the standard library supports
+            pass
+    return _stdlib_dumps(obj, indent=indent, default=default).encode()
+
+
+def loads(data):
+    """Deserialize a JSON document from a string or bytes."""
+    if orjson is None:
+        return json.loads(data)
+    return orjson.loads(data)
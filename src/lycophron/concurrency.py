@@ -0,0 +1,164 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Adaptive concurrency limits for the publishing stages."""
+
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from requests.exceptions import HTTPError
+
+from .state import StateFile
+
+
+def is_overload(error):
+    """Whether an error means that Zenodo is overloaded."""
+    if isinstance(error, HTTPError) and error.response is not None:
+        status_code = error.response.status_code
+        return status_code == 429 or status_code >= 500
+    return False
+
+
+class AIMDLimiter:
+    """Limit of the requests in flight, adapted with AIMD.
+
+    The limit grows by one request for every ``limit`` successful requests
+    (additive increase) and is halved on 429 and 5xx errors (multiplicative
+    decrease), including the 429 responses retried by the session and
+    reported with `throttled`. It does not grow while the latency is more
+    than ``tolerance`` times its moving average, so that it settles before
+    the latency degrades.
+    """
+
+    def __init__(
+        self, max_limit, min_limit=1, initial=None, backoff=0.5, tolerance=2.0
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial or min_limit)
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.latency = None
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        # Slot held by each thread, and whether it was throttled
+        self._local = threading.local()
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the slots while the block runs."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        self._local.held = True
+        self._local.throttled = False
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            overloaded = is_overload(e) or self._local.throttled
+            self._release(time.monotonic() - start, overloaded=overloaded)
+            raise
+        finally:
+            self._local.held = False
+        self._release(time.monotonic() - start, overloaded=self._local.throttled)
+
+    def throttled(self):
+        """Report a 429 response received in the slot of the current thread."""
+        if getattr(self._local, "held", False):
+            self._local.throttled = True
+
+    def _release(self, latency, overloaded=False):
+        with self._condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            elif self.latency is None or latency <= self.latency * self.tolerance:
+                self.limit = min(self.max_limit, self.limit + 1 / int(self.limit))
+            if not overloaded:
+                self.latency = (
+                    latency
+                    if self.latency is None
+                    else 0.8 * self.latency + 0.2 * latency
+                )
+            self._condition.notify_all()
+
+
+class ConcurrencyController:
+    """Adaptive concurrency limit of each publishing stage."""
+
+    def __init__(self, limits):
+        self.limiters = {
+            stage: AIMDLimiter(max_limit) for stage, max_limit in limits.items()
+        }
+
+    def slot(self, stage):
+        """Hold a slot of the given stage, stages without limit are free."""
+        limiter = self.limiters.get(stage)
+        return limiter.slot() if limiter else nullcontext()
+
+    def throttled(self):
+        """Report a 429 response to the stage slot of the current thread."""
+        for limiter in self.limiters.values():
+            limiter.throttled()
+
+    def limits(self):
+        """Current limit of each stage."""
+        return {stage: int(lim.limit) for stage, lim in self.limiters.items()}
+
+
+class AdaptiveChunkSize:
+    """Number of records per task, adapted to the observed record latency.
+
+    Chunks are sized so that a task takes about ``target`` seconds, from a
+    moving average of the time taken by each record. The average is written
+    to ``state_path``, so that the dispatcher sizes its chunks from the
+    records processed by the stage workers.
+    """
+
+    def __init__(
+        self, target=30.0, max_size=100, initial=10, weight=0.2, state_path=None
+    ):
+        self.target = target
+        self.max_size = max_size
+        self.initial = initial
+        self.weight = weight
+        self.state_path = state_path
+        self.latency = None
+        self._state = StateFile(state_path)
+        self._lock = threading.Lock()
+
+    def observe(self, latency, records=1):
+        """Record the mean time taken by a number of records, in seconds.
+
+        Observing a whole chunk at once weighs as much as observing each of
+        its records, and writes the state once.
+        """
+        with self._lock:
+            self._read_state()
+            if self.latency is None:
+                self.latency = latency
+            else:
+                weight = 1 - (1 - self.weight) ** records
+                self.latency += weight * (latency - self.latency)
+            self._write_state()
+
+    @property
+    def size(self):
+        """Current number of records per chunk."""
+        with self._lock:
+            self._read_state()
+        if not self.latency:
+            return min(self.initial, self.max_size)
+        return max(1, min(self.max_size, int(self.target / self.latency)))
+
+    def _read_state(self):
+        latency = self._state.read()
+        if latency is not None:
+            self.latency = latency
+
+    def _write_state(self):
+        self._state.write(self.latency)
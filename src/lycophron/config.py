@@ -256,6 +256,106 @@ class Defaults:
     RETRY_IGNORE_TIME = 3600 * 24
     # Maximum time, in seconds, for a record to be processed before being ignored
 
+    DISPATCH_BATCH_SIZE = 500
+    # Maximum number of records enqueued by each run of the dispatcher, a full
+    # batch triggers the next run right away
+
+    DISPATCH_POLL_INTERVAL = 60
+    # Interval, in seconds, of the periodic dispatch. Records are dispatched as
+    # soon as they are loaded, retried or finish a stage, this is a safety net
+
+    RETRY_MAX_ATTEMPTS = 8
+    RETRY_BACKOFF = 30
+    RETRY_BACKOFF_MAX = 3600
+    # Records hitting transient errors (rate limits, 5xx, connection errors) are
+    # retried up to RETRY_MAX_ATTEMPTS times, after a random delay of up to
+    # RETRY_BACKOFF * 2 ** attempt seconds, capped at RETRY_BACKOFF_MAX
+
+    BREAKER_THRESHOLD = 0.5
+    BREAKER_MIN_CALLS = 10
+    BREAKER_COOLDOWN = 30
+    # Publication is paused for BREAKER_COOLDOWN seconds when at least
+    # BREAKER_THRESHOLD of the last calls to Zenodo (and BREAKER_MIN_CALLS)
+    # failed because of an outage, then a single call probes Zenodo again
+
+    LEASE_TTL = 3600
+    # Time, in seconds, after which a record enqueued by the dispatcher can be
+    # enqueued again if its worker did not finish it (e.g. it crashed)
+
+    SSL_VERIFY = None
+    # Verify the certificate of ZENODO_URL: True, False or the path of a CA
+    # bundle. By default it is verified, except for local instances
+
+    HTTP_CONNECT_TIMEOUT = 10
+    HTTP_READ_TIMEOUT = 120
+    # Seconds to wait for a connection to Zenodo, and for its responses
+
+    HTTP_RETRIES = 3
+    # Number of retries of idempotent requests (e.g. GET) on connection errors
+    # and server errors
+
+    HTTP_POOL_SIZE = 0
+    # Number of connections to Zenodo kept alive by each worker process, 0 to
+    # size it for the concurrency of the workers
+
+    HTTP_TRANSPORT = "requests"
+    # HTTP client sending the requests to Zenodo: "requests", or "httpx" to
+    # multiplex them over a few HTTP/2 connections (requires the http2 extra)
+
+    RATE_LIMIT = 100
+    # Maximum number of requests per minute sent to Zenodo, shared by all the
+    # worker processes of the project
+
+    FILE_UPLOAD_CONCURRENCY = 4
+    # Maximum number of files of a record uploaded at the same time, all the
+    # uploads being bounded by the concurrency limit of the files stage
+
+    MULTIPART_THRESHOLD = 100 * 1024 * 1024
+    MULTIPART_PART_SIZE = 50 * 1024 * 1024
+    # Files larger than MULTIPART_THRESHOLD bytes are uploaded in parts of
+    # MULTIPART_PART_SIZE bytes, where the storage of Zenodo supports it, so
+    # that an interrupted upload resumes from its last part
+
+    UPLOAD_CHUNK_SIZE = 1024 * 1024
+    # Size, in bytes, of the chunks in which files are streamed to Zenodo, the
+    # memory used by an upload does not depend on the size of the file
+
+    UPLOAD_READ_AHEAD = 4
+    # Number of chunks read from disk ahead of the one being sent, including
+    # the first chunks of the next files to upload
+
+    UPLOAD_BANDWIDTH = 0
+    UPLOAD_BANDWIDTH_PER_WORKER = 0
+    # Maximum upload rate, in bytes per second, of all uploads together and of
+    # each worker thread (the files of the record it uploads), 0 for no limit
+
+    UPLOAD_RESTRICTED_HOURS = []
+    # Local time windows during which files are not uploaded, e.g.
+    # ["mon-fri 08:00-18:00"]; the other stages keep running. Changes to
+    # these settings and the bandwidth caps apply without restarting workers
+
+    DEFER_CHECKSUMS = False
+    # Compute the checksums of the files while uploading them rather than when
+    # loading them, so that each file is read once, e.g. on network storage
+
+    CONCURRENCY_LIMITS = {"draft": 4, "metadata": 8, "files": 4, "publish": 4}
+    # Maximum number of requests in flight for each stage, the actual limits
+    # adapt to the latency and errors of Zenodo. Each stage has its own queue,
+    # consumed by a worker with as many threads
+
+    STAGE_RATE_LIMITS = {}
+    # Maximum number of records per minute going through a stage, by stage name
+    # (e.g. {"files": 20}), on top of RATE_LIMIT
+
+    CHUNK_DURATION = 30
+    CHUNK_MAX_SIZE = 100
+    # Records are sent to the worker in chunks sized so that each one takes
+    # about CHUNK_DURATION seconds, with at most CHUNK_MAX_SIZE records
+
+    RESPONSE_RETENTION = "compact"
+    # Zenodo responses kept for successful steps: "compact" keeps the id, DOI,
+    # links and errors, "full" keeps the whole payload. Failures are always full.
+
 
 required_configs = ["TOKEN", "SQLALCHEMY_DATABASE_URI", "ZENODO_URL"]
 
@@ -264,6 +364,7 @@ class Config(dict):
     def __init__(self, root_path, defaults) -> None:
         self.defaults = defaults
         self.root_path = root_path
+        self._cfg_mtime = None
 
     def __setitem__(self, __key, __value) -> None:
         if not str(__key).isupper():
@@ -290,10 +391,29 @@ class Config(dict):
         self.create()
 
     def load(self):
+        self._cfg_mtime = self._get_cfg_mtime()
         for loader in [self.defaultsLoader, self.cfgLoader]:
             configs = loader.load()
             self.update(**configs)
 
+    def reload_if_changed(self) -> bool:
+        """Load the config file again if it changed since it was loaded.
+
+        Lets running workers pick up new settings, e.g. bandwidth caps.
+        """
+        mtime = self._get_cfg_mtime()
+        if mtime is None or mtime == self._cfg_mtime:
+            return False
+        logger.info(f"{self.cfgLoader.file_name} changed, reloading it")
+        self.load()
+        return True
+
+    def _get_cfg_mtime(self):
+        try:
+            return os.stat(self.cfgLoader.cfg_path).st_mtime_ns
+        except OSError:
+            return None
+
     def create(self):
         if not self.cfgLoader.exists():
             self.cfgLoader.create()
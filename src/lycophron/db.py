@@ -5,38 +5,24 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 """Database manager for Lycophron."""
 
-import json
 import logging
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import UTC, datetime, timedelta
 from hashlib import md5
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, inspect, literal, or_, text, update
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy_utils.functions import create_database, database_exists, drop_database
 
+from . import codec
 from .errors import DatabaseAlreadyExists, DatabaseNotFound, DatabaseResourceNotModified
 from .models import Community, File, Model, Record, RecordStatus
 from .references import ReferenceManager
+from .responses import retain_response
 
 logger = logging.getLogger("lycophron")
 
-
-def custom_serializer(o):
-    from .template import LazyReference
-
-    if isinstance(o, datetime):
-        return str(o)
-    elif isinstance(o, LazyReference):
-        # Serialize a LazyReference object to a dictionary
-        return {
-            "type": "lazy_reference",
-            "record_id": o.record_id,
-            "field": o.field,
-            "bidirectional": o.bidirectional,
-        }
-    else:
-        # For all other types, use the default serialization
-        return json.dumps(o, default=str)
+ID_BATCH_SIZE = 500
 
 
 def file_checksum(filename):
@@ -52,7 +38,11 @@ class LycophronDB:
 
     def __init__(self, uri) -> None:
         self.engine = create_engine(
-            uri, json_serializer=custom_serializer, pool_recycle=3600, pool_size=10
+            uri,
+            json_serializer=codec.dumps,
+            json_deserializer=codec.loads,
+            pool_recycle=3600,
+            pool_size=10,
         )
         _session_factory = sessionmaker(
             bind=self.engine, autocommit=False, autoflush=False
@@ -60,12 +50,73 @@ class LycophronDB:
         self.session = scoped_session(_session_factory)
         self.reference_manager = ReferenceManager(self.session)
 
+    @contextmanager
+    def task_scope(self):
+        """Scope the thread-local session to a unit of work, e.g. a task.
+
+        The session is rolled back on errors and removed at the end, which
+        closes it, releases its connection and empties its identity map. Long
+        running workers therefore do not accumulate the records they process.
+        """
+        try:
+            yield self.session
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.session.remove()
+
     def init_db(self) -> None:
         """Initializes the lycophron database."""
         self._create_database()
         Model.metadata.create_all(self.engine)
         logger.info("Database initialized.")
 
+    def upgrade_schema(self) -> list[str]:
+        """Add the tables, columns and indexes missing from an existing DB.
+
+        Tables are created once, by `init_db`, so the DB of a project created
+        by an older version lacks what was added to the models since. This is
+        a no-op on an up-to-date DB.
+
+        :return: names of the added tables, columns and indexes
+        :rtype: list[str]
+        """
+        added = []
+        inspector = inspect(self.engine)
+        quote = self.engine.dialect.identifier_preparer.quote
+        tables = set(inspector.get_table_names())
+        for table in Model.metadata.sorted_tables:
+            if table.name not in tables:
+                table.create(self.engine)
+                added.append(table.name)
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                ddl = (
+                    f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} "
+                    f"{column.type.compile(dialect=self.engine.dialect)}"
+                )
+                if column.default is not None and column.default.is_scalar:
+                    value = literal(column.default.arg, column.type).compile(
+                        dialect=self.engine.dialect,
+                        compile_kwargs={"literal_binds": True},
+                    )
+                    ddl += f" DEFAULT {value}"
+                with self.engine.begin() as conn:
+                    conn.execute(text(ddl))
+                added.append(f"{table.name}.{column.name}")
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(self.engine)
+                    added.append(index.name)
+        if added:
+            logger.info("Database upgraded, added: %s.", ", ".join(added))
+        return added
+
     def _drop_database(self) -> None:
         """Drops the database"""
         drop_database(self.engine.url)
@@ -96,11 +147,13 @@ class LycophronDB:
         """
         return database_exists(self.engine.url)
 
-    def add_record(self, record: dict) -> None:
+    def add_record(self, record: dict, checksums=True) -> None:
         """Add a record to the DB.
 
         :param record: deserialized record
         :type record: dict
+        :param checksums: whether to compute the checksums of the files now,
+            rather than while uploading them
         """
         logger.debug("Adding record %s", record.get("id"))
         if not self.database_exists():
@@ -120,7 +173,8 @@ class LycophronDB:
             comm_obj = Community(slug=comm_slug)
             new_record.communities.append(comm_obj)
         for filename in cleaned_files:
-            file = File(filename=filename, checksum=file_checksum(f"files/{filename}"))
+            checksum = file_checksum(f"files/{filename}") if checksums else None
+            file = File(filename=filename, checksum=checksum)
             new_record.files.append(file)
         self.session.add(new_record)
         repr = record.get("id") or record.get("title")
@@ -203,6 +257,198 @@ class LycophronDB:
         records = query.all()
         return records
 
+    def _pending_records(self, updated_after=None):
+        """Query the records that are neither failed nor finished.
+
+        :param updated_after: skip the records, other than new ones, not
+            updated since then
+        """
+        query = self.session.query(Record).filter(
+            Record.status.notin_(
+                RecordStatus.failed_statuses | RecordStatus.finished_statuses
+            )
+        )
+        if updated_after is not None:
+            query = query.filter(
+                or_(Record.status == RecordStatus.TODO, Record.updated >= updated_after)
+            )
+        return query
+
+    def get_dispatchable_records(self, number=None, updated_after=None, drafted=None):
+        """Return the records that can be enqueued, ordered by ID.
+
+        These are the records that are neither failed nor finished, whose
+        lease is free or has expired and whose next attempt, if scheduled, is
+        due.
+
+        :param updated_after: skip the records, other than new ones, not
+            updated since then
+        :param drafted: only return the records with (True) or without (False)
+            a draft on Zenodo
+        """
+        if not self.database_exists():
+            raise DatabaseNotFound("Database not found. Aborting record fetching.")
+        now = datetime.now(UTC).replace(tzinfo=None)
+        query = self._pending_records(updated_after).filter(
+            or_(Record.lease_expires_at.is_(None), Record.lease_expires_at < now),
+            or_(Record.next_attempt_at.is_(None), Record.next_attempt_at <= now),
+        )
+        if drafted is not None:
+            query = query.filter(
+                Record.upload_id.isnot(None) if drafted else Record.upload_id.is_(None)
+            )
+        query = query.order_by(Record.id)
+        if number:
+            query = query.limit(number)
+        return query.all()
+
+    def get_next_attempt_at(self) -> datetime | None:
+        """Return when the next deferred record is due, None if none is.
+
+        Records are deferred by automatic retries, an open circuit breaker or
+        the restricted upload hours.
+        """
+        return (
+            self._pending_records()
+            .with_entities(func.min(Record.next_attempt_at))
+            .scalar()
+        )
+
+    def has_pending_drafts(self, updated_after=None) -> bool:
+        """Whether records still wait for their draft, e.g. queued or retried.
+
+        :param updated_after: see `get_dispatchable_records`
+        """
+        query = self._pending_records(updated_after).filter(Record.upload_id.is_(None))
+        return self.session.query(query.exists()).scalar()
+
+    def lease_records(self, ids, owner, ttl) -> list[str]:
+        """Lease the given records to ``owner`` for ``ttl`` seconds.
+
+        Records leased to someone else are skipped. Leases are taken in a
+        single conditional update, so that concurrent dispatchers never lease
+        the same record, and expired leases (e.g. of crashed workers) are
+        taken over.
+
+        :return: IDs of the leased records
+        :rtype: list[str]
+        """
+        now = datetime.now(UTC).replace(tzinfo=None)
+        leased = []
+        ids = list(ids)
+        for i in range(0, len(ids), ID_BATCH_SIZE):
+            stmt = (
+                update(Record)
+                .where(
+                    Record.id.in_(ids[i : i + ID_BATCH_SIZE]),
+                    or_(
+                        Record.lease_expires_at.is_(None),
+                        Record.lease_expires_at < now,
+                    ),
+                )
+                .values(
+                    lease_owner=owner,
+                    lease_expires_at=now + timedelta(seconds=ttl),
+                )
+                .returning(Record.id)
+                .execution_options(synchronize_session=False)
+            )
+            leased.extend(self.session.execute(stmt).scalars())
+        self.session.commit()
+        return leased
+
+    def renew_lease(self, record_id, owner, ttl) -> bool:
+        """Extend the lease of a record by ``ttl`` seconds from now.
+
+        The lease is only extended if still held by ``owner``, even if it has
+        expired in the meantime, as long as nobody else took it over.
+
+        :return: whether the lease is still held by ``owner``
+        :rtype: bool
+        """
+        now = datetime.now(UTC).replace(tzinfo=None)
+        stmt = (
+            update(Record)
+            .where(Record.id == record_id, Record.lease_owner == owner)
+            .values(lease_expires_at=now + timedelta(seconds=ttl))
+            .execution_options(synchronize_session=False)
+        )
+        renewed = self.session.execute(stmt).rowcount == 1
+        self.session.commit()
+        return renewed
+
+    def release_lease(self, record_id, owner) -> bool:
+        """Release the lease of a record, if still held by ``owner``.
+
+        :return: whether the lease was released
+        :rtype: bool
+        """
+        stmt = (
+            update(Record)
+            .where(Record.id == record_id, Record.lease_owner == owner)
+            .values(lease_owner=None, lease_expires_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        released = self.session.execute(stmt).rowcount == 1
+        self.session.commit()
+        return released
+
+    def get_pending_record_ids(
+        self, statuses=None, after=None, number=None, drafted=None
+    ):
+        """Return the IDs of records due to be processed, ordered by ID.
+
+        :param statuses: only return records in these statuses, defaults to all
+            the statuses that are neither failed nor finished
+        :param after: only return IDs greater than this one, to page through
+        :param number: maximum number of IDs
+        :param drafted: only return records with (True) or without (False) a
+            draft, defaults to both
+        :rtype: list[str]
+        """
+        query = self.session.query(Record.id)
+        if statuses is None:
+            query = query.filter(
+                Record.status.notin_(
+                    RecordStatus.failed_statuses | RecordStatus.finished_statuses
+                )
+            )
+        else:
+            query = query.filter(Record.status.in_(statuses))
+        now = datetime.now(UTC).replace(tzinfo=None)
+        query = query.filter(
+            or_(Record.next_attempt_at.is_(None), Record.next_attempt_at <= now)
+        )
+        if drafted is not None:
+            query = query.filter(
+                Record.upload_id.isnot(None) if drafted else Record.upload_id.is_(None)
+            )
+        if after is not None:
+            query = query.filter(Record.id > after)
+        query = query.order_by(Record.id)
+        if number:
+            query = query.limit(number)
+        return [record_id for (record_id,) in query]
+
+    def queue_new_records(self) -> int:
+        """Set all new records to `QUEUED` with a bulk update.
+
+        :return: number of queued records
+        :rtype: int
+        """
+        stmt = (
+            update(Record)
+            .where(Record.status == RecordStatus.TODO)
+            .values(
+                status=RecordStatus.QUEUED,
+                updated=datetime.now(UTC).replace(tzinfo=None),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        n_records = self.session.execute(stmt).rowcount
+        self.session.commit()
+        return n_records
+
     def get_failed_records(self, number=None):
         """Return failed records."""
         query = self.session.query(Record).filter(
@@ -212,6 +458,58 @@ class LycophronDB:
             query = query.limit(number)
         return query
 
+    def reset_failed_records(
+        self, statuses=None, error=None, http_status=None, ids=None
+    ) -> int:
+        """Reset failed records to `TODO` with a bulk update.
+
+        :param statuses: failed statuses to reset, defaults to all of them
+        :param error: substring of the stored error or response message
+        :param http_status: HTTP status code stored in the response
+        :param ids: record IDs to reset
+        :return: number of records that were reset
+        :rtype: int
+        """
+        if not self.database_exists():
+            raise DatabaseNotFound("Database not found. Aborting record update.")
+
+        statuses = set(statuses or RecordStatus.failed_statuses)
+        if not statuses <= RecordStatus.failed_statuses:
+            raise ValueError(f"Not failed statuses: {statuses}")
+
+        stmt = update(Record).where(Record.status.in_(statuses))
+        if error:
+            stmt = stmt.where(
+                or_(
+                    Record.error.contains(error, autoescape=True),
+                    Record.response["message"]
+                    .as_string()
+                    .contains(error, autoescape=True),
+                )
+            )
+        if http_status:
+            stmt = stmt.where(Record.response["status"].as_integer() == http_status)
+        stmt = stmt.values(
+            status=RecordStatus.TODO,
+            attempt_count=0,
+            next_attempt_at=None,
+            updated=datetime.now(UTC).replace(tzinfo=None),
+        ).execution_options(synchronize_session=False)
+
+        if ids is None:
+            n_records = self.session.execute(stmt).rowcount
+        else:
+            # Keep the number of bound parameters under the SQLite limit
+            ids = list(ids)
+            n_records = sum(
+                self.session.execute(
+                    stmt.where(Record.id.in_(ids[i : i + ID_BATCH_SIZE]))
+                ).rowcount
+                for i in range(0, len(ids), ID_BATCH_SIZE)
+            )
+        self.session.commit()
+        return n_records
+
     def update_record_status(self, record: Record, status: RecordStatus):
         """Update record status."""
         logger.debug("Updating record %s status to %s", record.id, status)
@@ -230,6 +528,78 @@ class LycophronDB:
         self.session.commit()
         return record
 
+    def count_by_status(self):
+        """Count records and files per status.
+
+        Both queries are answered from the status indexes, without loading any
+        record.
+
+        :return: record counts with the oldest ``updated`` timestamp per record
+            status, and file counts per file status
+        :rtype: tuple[dict, dict]
+        """
+        records = {
+            status: (count, oldest)
+            for status, count, oldest in self.session.query(
+                Record.status, func.count(), func.min(Record.updated)
+            ).group_by(Record.status)
+        }
+        files = dict(
+            self.session.query(File.status, func.count()).group_by(File.status).all()
+        )
+        return records, files
+
+    def compact_responses(self, policy, batch_size=500) -> int:
+        """Apply the response retention policy to the stored responses.
+
+        Responses are rewritten in batches, which also compresses the large
+        ones, and the space is reclaimed afterwards on SQLite.
+
+        :return: number of rewritten responses
+        :rtype: int
+        """
+        if not self.database_exists():
+            raise DatabaseNotFound("Database not found. Aborting compaction.")
+
+        n_records = 0
+        last_id = ""
+        while True:
+            rows = (
+                self.session.query(Record.id, Record.status, Record.response)
+                .filter(Record.id > last_id)
+                .order_by(Record.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            last_id = rows[-1].id
+            values = [
+                {
+                    "id": row.id,
+                    "response": retain_response(
+                        row.response,
+                        failed=row.status in RecordStatus.failed_statuses,
+                        policy=policy,
+                    ),
+                }
+                for row in rows
+                if row.response is not None
+            ]
+            if values:
+                # Bulk update by primary key, which keeps `updated` untouched
+                self.session.execute(update(Record), values)
+                self.session.commit()
+            n_records += len(values)
+
+        if self.engine.dialect.name == "sqlite":
+            with self.engine.connect() as conn:
+                conn.execution_options(isolation_level="AUTOCOMMIT").execute(
+                    text("VACUUM")
+                )
+        logger.info("Compacted %d responses.", n_records)
+        return n_records
+
     def _record_to_dict(self, record, columns):
         return {c.key: getattr(record, c.key) for c in columns}
 
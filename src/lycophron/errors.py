@@ -37,7 +37,7 @@ class ConfigNotFound(ConfigError):
 
 class InvalidConfig(ConfigError):
     def __init__(self, *, key, value):
-        super().__init__(f"Invalid value '{value}' for config '{key}'")
+        super().__init__(message=f"Invalid value '{value}' for config '{key}'")
 
 
 class DatabaseError(LycophronError):
@@ -62,6 +62,12 @@ class RecordError(LycophronError):
     message = "Record error occurred."
 
 
+class ChecksumMismatch(RecordError):
+    error_type = "FILE"
+    message = "File checksum mismatch."
+    hint = "Load the record again if the file was modified on purpose."
+
+
 class InvalidDirectoryError(LycophronError):
     error_type = "DIRECTORY"
     hint = (
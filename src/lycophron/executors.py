@@ -0,0 +1,137 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""In-process executors for publishing records without a Celery worker."""
+
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime
+
+from .logger import logger
+from .tasks.tasks import process_record
+
+
+class Executor(ABC):
+    """Publishes the pending records of a project from the current process.
+
+    Work is read directly from the project DB in pages and every record goes
+    through the same state machine as with the Celery worker (see
+    `process_record`). Implementations only differ in how records are
+    scheduled.
+    """
+
+    def __init__(self, project, concurrency=4, page_size=500):
+        self.project = project
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self._stopping = threading.Event()
+        self._processed = set()
+
+    @property
+    def stopping(self):
+        """Whether the executor was asked to stop."""
+        return self._stopping.is_set()
+
+    def stop(self):
+        """Stop taking new records, the records in progress are finished."""
+        self._stopping.set()
+
+    def run(self) -> int:
+        """Publish all pending records.
+
+        As with `record_dispatcher`, the drafts of all the records are created
+        first, so that every record has a DOI before cross-references are
+        resolved, then the records with a draft go through the other stages.
+        Records deferred while processing them (automatic retries, an open
+        circuit breaker, the restricted upload hours) are processed again
+        when they are due, until none is pending.
+
+        :return: number of processed records
+        :rtype: int
+        """
+        self.project.db.queue_new_records()
+        self._processed = set()
+        while True:
+            self._process(self._record_ids(drafted=False), stages=("draft",))
+            if not self.stopping and not self._has_pending_drafts():
+                self._process(self._record_ids(drafted=True))
+            if not self._wait_for_deferred():
+                return len(self._processed)
+
+    def _has_pending_drafts(self) -> bool:
+        with self.project.db.task_scope():
+            return self.project.db.has_pending_drafts()
+
+    def _wait_for_deferred(self) -> bool:
+        """Wait until the next deferred record is due.
+
+        :return: False if no record is deferred or the executor was stopped
+        """
+        if self.stopping:
+            return False
+        with self.project.db.task_scope():
+            next_attempt_at = self.project.db.get_next_attempt_at()
+        if next_attempt_at is None:
+            return False
+        delay = (
+            next_attempt_at - datetime.now(UTC).replace(tzinfo=None)
+        ).total_seconds()
+        if delay > 0:
+            logger.info(f"Waiting {delay:.0f}s for the deferred records")
+        return not self._stopping.wait(max(delay, 0))
+
+    def _record_ids(self, drafted=None):
+        """Page through the IDs of the records to process."""
+        after = None
+        while not self.stopping:
+            with self.project.db.task_scope():
+                ids = self.project.db.get_pending_record_ids(
+                    after=after, number=self.page_size, drafted=drafted
+                )
+            if not ids:
+                return
+            for record_id in ids:
+                if self.stopping:
+                    return
+                self._processed.add(record_id)
+                yield record_id
+            after = ids[-1]
+
+    def process(self, record_id, stages=None):
+        """Process a single record, errors are logged and not raised.
+
+        :param stages: see `process_record`
+        """
+        try:
+            # Call the task function directly, not through Celery
+            process_record.run(record_id, stages=stages)
+        except Exception as e:
+            logger.error(f"Error processing record {record_id=}: {e=}")
+
+    @abstractmethod
+    def _process(self, record_ids, stages=None):
+        """Process the given records, see `process`."""
+
+
+class ThreadExecutor(Executor):
+    """Publishes records from a pool of threads."""
+
+    def _process(self, record_ids, stages=None):
+        # Bound the submitted records so that IDs are read as they are needed
+        slots = threading.BoundedSemaphore(self.concurrency)
+        with ThreadPoolExecutor(
+            self.concurrency, thread_name_prefix="lycophron"
+        ) as pool:
+            for record_id in record_ids:
+                slots.acquire()
+                pool.submit(self.process, record_id, stages).add_done_callback(
+                    lambda _: slots.release()
+                )
+
+
+EXECUTORS = {
+    "threads": ThreadExecutor,
+}
@@ -5,21 +5,28 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 """Lycophron data models."""
 
+import base64
 import enum
+import zlib
 
 from sqlalchemy import (
     JSON,
     Boolean,
     Column,
+    DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
     String,
+    TypeDecorator,
     UniqueConstraint,
 )
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy_utils.models import Timestamp
 
+from . import codec
+
 Model = declarative_base()
 
 
@@ -31,6 +38,42 @@ class classproperty:
         return self.fget(owner)
 
 
+class CompressedJSON(TypeDecorator):
+    """JSON column that transparently compresses large values.
+
+    Values whose serialization exceeds ``threshold`` bytes are stored as a
+    zlib-compressed, base64-encoded string under the ``$zlib`` key. The
+    ``status`` and ``message`` keys are kept next to it so that they remain
+    queryable.
+    """
+
+    impl = JSON
+    cache_ok = True
+
+    threshold = 4096
+    queryable_keys = ("status", "message")
+
+    def process_bind_param(self, value, dialect):
+        if not isinstance(value, dict | list):
+            return value
+        serialized = codec.dumps_bytes(value)
+        if len(serialized) <= self.threshold:
+            return value
+        compressed = {
+            "$zlib": base64.b64encode(zlib.compress(serialized)).decode("ascii")
+        }
+        if isinstance(value, dict):
+            compressed.update(
+                {key: value[key] for key in self.queryable_keys if key in value}
+            )
+        return compressed
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, dict) and "$zlib" in value:
+            return codec.loads(zlib.decompress(base64.b64decode(value["$zlib"])))
+        return value
+
+
 class RecordStatus(str, enum.Enum):
     TODO = "NEW"
     QUEUED = "QUEUED"
@@ -63,11 +106,31 @@ class RecordStatus(str, enum.Enum):
             RecordStatus.COMMUNITIES_FAILED,
         }
 
+    @classproperty
+    def failed_stages(self):
+        """Pipeline stage in which each failed status occurred."""
+        return {
+            RecordStatus.DRAFT_FAILED: "draft",
+            RecordStatus.METADATA_FAILED: "metadata",
+            RecordStatus.FILE_FAILED: "files",
+            RecordStatus.PUBLISH_FAILED: "publish",
+            RecordStatus.COMMUNITIES_FAILED: "communities",
+        }
+
+    @classproperty
+    def finished_statuses(self):
+        """Set of statuses that need no further processing."""
+        return {RecordStatus.PUBLISHED, RecordStatus.COMMUNITIES_ADDED}
+
 
 class Record(Model, Timestamp):
     """Local representation of a record."""
 
     __tablename__ = "record"
+    __table_args__ = (
+        # Covers the per-status aggregates (counts, oldest update) of `status`
+        Index("ix_record_status_updated", "status", "updated"),
+    )
 
     id = Column(String, primary_key=True)
 
@@ -91,9 +154,19 @@ class Record(Model, Timestamp):
 
     # State
     status = Column(Enum(RecordStatus), default=RecordStatus.TODO)
-    response = Column(JSON, default=None)  # TODO response, errors
+    # Last response of Zenodo, see `responses.retain_response`
+    response = Column(CompressedJSON, default=None)
     error = Column(String, default=None)
 
+    # Lease taken by the dispatcher when the record is enqueued, so that it is
+    # not enqueued again while a worker holds it (see `LycophronDB.lease_records`)
+    lease_owner = Column(String, default=None)
+    lease_expires_at = Column(DateTime, default=None)
+
+    # Automatic retries of transient errors, see `retries.is_transient`
+    attempt_count = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=None)
+
     @property
     def failed(self):
         """Check if the record is in a failed state."""
@@ -123,8 +196,10 @@ class File(Model, Timestamp):
     id = Column(Integer, primary_key=True, autoincrement=True)
     record_id = Column(String, ForeignKey("record.id"))
     filename = Column(String)
-    status = Column(Enum(FileStatus), default=FileStatus.TODO)
+    status = Column(Enum(FileStatus), default=FileStatus.TODO, index=True)
     checksum = Column(String)
+    # Parts of a multipart upload already sent, to resume it after a failure
+    uploaded_parts = Column(Integer, default=0)
 
     UniqueConstraint(record_id, filename, name="unique_file_per_record")
 
@@ -13,7 +13,7 @@ from .db import LycophronDB
 from .errors import DatabaseError, RecordValidationError
 from .loaders import LoaderFactory
 from .logger import logger
-from .models import Record, RecordStatus
+from .models import FileStatus, Record, RecordStatus
 from .schemas.record import RecordRow
 from .serializers import CSVSerializer
 
@@ -24,8 +24,11 @@ class Project:
 
     @cached_property
     def db(self):
-        """Get the database."""
-        return LycophronDB(uri=self.db_uri)
+        """Get the database, upgraded to the current models if needed."""
+        db = LycophronDB(uri=self.db_uri)
+        if db.database_exists():
+            db.upgrade_schema()
+        return db
 
     @property
     def db_uri(self):
@@ -43,7 +46,9 @@ class Project:
         data = self.process_file(filename, config)
         for record in data:
             try:
-                self.add_or_update_record(record)
+                self.add_or_update_record(
+                    record, checksums=not config["DEFER_CHECKSUMS"]
+                )
             except DatabaseError as e:
                 logger.warn(e)
             except Exception as e:
@@ -65,10 +70,10 @@ class Project:
                 records.append(record)
         return records
 
-    def add_or_update_record(self, record):
+    def add_or_update_record(self, record, checksums=True):
         db_record = self.db.get_record(record["id"])
         if not db_record:
-            self.db.add_record(record)
+            self.db.add_record(record, checksums=checksums)
         else:
             self.db.update_record(db_record, record)
 
@@ -147,11 +152,50 @@ class Project:
             res.append(_r)
         return serializer().serialize(res)
 
-    def retry_failed(self):
-        """Reset status of failed records to `TODO`."""
-        records = self.db.get_failed_records()
-        n_records = 0
-        for record in records:
-            self.db.update_record_status(record, RecordStatus.TODO)
-            n_records += 1
-        return n_records
+    def status_summary(self):
+        """Summarize the progress of the project.
+
+        Only aggregate queries are run, so this is cheap enough to be polled
+        regardless of the number of records.
+
+        :return: counts per record and file status, failure counts per stage
+            and the oldest ``updated`` timestamp of the pending records.
+        :rtype: dict
+        """
+        records, files = self.db.count_by_status()
+        pending = [
+            oldest
+            for status, (_, oldest) in records.items()
+            if status not in RecordStatus.failed_statuses
+            and status not in RecordStatus.finished_statuses
+        ]
+        return {
+            "total": sum(count for count, _ in records.values()),
+            "records": {
+                status.value: records.get(status, (0, None))[0]
+                for status in RecordStatus
+            },
+            "files": {status.value: files.get(status, 0) for status in FileStatus},
+            "failures": {
+                stage: records.get(status, (0, None))[0]
+                for status, stage in RecordStatus.failed_stages.items()
+            },
+            "oldest_pending": min(pending, default=None),
+        }
+
+    def compact_responses(self, config):
+        """Apply the configured retention policy to the stored responses."""
+        return self.db.compact_responses(policy=config["RESPONSE_RETENTION"])
+
+    def retry_failed(self, statuses=None, error=None, http_status=None, ids=None):
+        """Reset status of failed records to `TODO`.
+
+        All filters are optional and combined, see
+        :meth:`LycophronDB.reset_failed_records`.
+
+        :return: number of records queued for retrying
+        :rtype: int
+        """
+        return self.db.reset_failed_records(
+            statuses=statuses, error=error, http_status=http_status, ids=ids
+        )
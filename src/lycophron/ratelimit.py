@@ -0,0 +1,177 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Rate limiting of the requests sent to Zenodo."""
+
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+from .state import StateFile
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_BACKOFF = 60
+# Seconds to back off on a 429 response without a Retry-After header
+
+
+def parse_retry_after(value, now=None):
+    """Return the seconds to wait from a ``Retry-After`` header value.
+
+    The value is either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - (now or time.time()), 0.0)
+
+
+def parse_reset(value, now=None):
+    """Return the seconds left from a ``X-RateLimit-Reset`` header value.
+
+    Zenodo sends an epoch timestamp, small values are taken as seconds.
+    """
+    try:
+        reset = float(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or time.time()
+    return max(reset - now if reset > 1e9 else reset, 0.0)
+
+
+class RateLimiter:
+    """Token bucket shared by all the threads of a process.
+
+    Requests are paced at ``rate`` per minute, with bursts of up to ``burst``
+    requests. The pace is lowered to the budget left announced by the
+    ``X-RateLimit-*`` headers of the responses, and a 429 response blocks all
+    requests until its ``Retry-After`` has passed. Blocks are written to
+    ``state_path`` so that the other processes of the project back off too,
+    and the bucket is kept, under a file lock, in ``<state_path>.bucket`` so
+    that they share the same budget, whichever of them is busy. If set,
+    ``on_throttle`` is called on every 429 response.
+    """
+
+    def __init__(self, rate, burst=10, state_path=None, on_throttle=None):
+        self.max_rate = rate / 60
+        self.rate = self.max_rate
+        self.burst = burst
+        self.state_path = state_path
+        self.on_throttle = on_throttle
+        self.bucket_path = f"{state_path}.bucket" if state_path and fcntl else None
+        self._tokens = float(burst)
+        # Wall clock times, so that they can be shared with other processes
+        self._last = time.time()
+        self._blocked_until = 0.0
+        self._state = StateFile(state_path)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request can be sent."""
+        while True:
+            with self._lock:
+                delay = self.blocked_for()
+                with self._bucket():
+                    now = time.time()
+                    if delay > 0:
+                        # Do not let tokens pile up while blocked, to avoid a
+                        # burst of requests once the block is over
+                        self._tokens = 0.0
+                    else:
+                        elapsed = max(now - self._last, 0.0)
+                        self._tokens = min(
+                            self.burst, self._tokens + elapsed * self.rate
+                        )
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            self._last = now
+                            return
+                        delay = (1 - self._tokens) / self.rate
+                    self._last = now
+            time.sleep(delay)
+
+    @contextmanager
+    def _bucket(self):
+        """Load the shared bucket, locked, and store it back afterwards."""
+        if not self.bucket_path:
+            yield
+            return
+        with open(self.bucket_path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    self._tokens, self._last = (float(v) for v in f.read().split())
+                except ValueError:
+                    # New bucket, start from the tokens of this process
+                    pass
+                yield
+                f.seek(0)
+                f.truncate()
+                f.write(f"{self._tokens!r} {self._last!r}")
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def wait(self):
+        """Wait until the current block, if any, is over."""
+        while (delay := self.blocked_for()) > 0:
+            time.sleep(delay)
+
+    def blocked_for(self):
+        """Return the seconds left before requests can be sent again."""
+        self._read_state()
+        return self._blocked_until - time.time()
+
+    def block(self, seconds):
+        """Block all requests for the given number of seconds."""
+        until = time.time() + seconds
+        if until <= self._blocked_until:
+            return
+        self._blocked_until = until
+        self._write_state()
+
+    def update(self, response):
+        """Adjust the pace from the rate limit headers of a response."""
+        headers = response.headers
+        reset = parse_reset(headers.get("X-RateLimit-Reset"))
+        if response.status_code == 429:
+            if self.on_throttle:
+                self.on_throttle()
+            retry_after = parse_retry_after(headers.get("Retry-After"))
+            if retry_after is None:
+                retry_after = reset or DEFAULT_BACKOFF
+            self.block(retry_after)
+            return
+        try:
+            remaining = int(headers["X-RateLimit-Remaining"])
+        except (KeyError, ValueError):
+            return
+        if not reset:
+            self.rate = self.max_rate
+        elif remaining <= 0:
+            self.block(reset)
+        else:
+            # Spread the budget left over the rest of the window
+            self.rate = min(self.max_rate, remaining / reset)
+
+    def _read_state(self):
+        blocked_until = self._state.read()
+        if blocked_until is not None:
+            self._blocked_until = max(self._blocked_until, blocked_until)
+
+    def _write_state(self):
+        self._state.write(self._blocked_until)
@@ -0,0 +1,55 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Retention policy for the InvenioRDM responses stored in the records."""
+
+import enum
+
+from inveniordm_py.metadata import Metadata
+
+
+class ResponseRetention(str, enum.Enum):
+    FULL = "full"
+    COMPACT = "compact"
+
+
+# Top-level keys kept in a compact response, including the DOI of compact ones
+COMPACT_FIELDS = ("id", "status", "message", "errors", "links", "doi")
+
+
+def response_data(response):
+    """Get the JSON data of a response.
+
+    Resources of the client return their payload wrapped in a metadata object.
+    """
+    if isinstance(response, Metadata):
+        return response._data
+    return response
+
+
+def compact_response(response):
+    """Project a response onto the fields needed to follow up on a record.
+
+    Compacting a compact response returns it unchanged.
+    """
+    data = response_data(response)
+    if not isinstance(data, dict):
+        return data
+    compact = {key: data[key] for key in COMPACT_FIELDS if key in data}
+    doi = (data.get("pids") or {}).get("doi", {}).get("identifier")
+    if doi:
+        compact["doi"] = doi
+    return compact
+
+
+def retain_response(response, failed=False, policy=ResponseRetention.COMPACT):
+    """Apply the retention policy to a response before storing it.
+
+    The full payload is kept for failed records, so that the error can be
+    investigated.
+    """
+    if failed or policy == ResponseRetention.FULL:
+        return response_data(response)
+    return compact_response(response)
@@ -0,0 +1,51 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Classification of errors and backoff of the records to retry."""
+
+import random
+
+from requests.exceptions import (
+    ChunkedEncodingError,
+    ConnectionError,
+    HTTPError,
+    Timeout,
+)
+
+# HTTP statuses of requests worth sending again later, besides 5xx
+TRANSIENT_STATUS_CODES = {408, 425, 429}
+
+
+def is_transient(error) -> bool:
+    """Whether an error may go away by itself, e.g. rate limits or outages.
+
+    Other errors, like a 400 on invalid metadata, need a fix before the record
+    is retried.
+    """
+    if isinstance(error, HTTPError):
+        if error.response is None:
+            return False
+        status_code = error.response.status_code
+        return status_code in TRANSIENT_STATUS_CODES or status_code >= 500
+    return isinstance(error, ConnectionError | Timeout | ChunkedEncodingError)
+
+
+def backoff(attempt, base=30.0, cap=3600.0) -> float:
+    """Return the seconds to wait before the given attempt, with full jitter.
+
+    The jitter spreads the records that failed together, e.g. during an outage,
+    so that they are not all retried at the same time.
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def is_outage(error) -> bool:
+    """Whether an error means that Zenodo is unavailable.
+
+    Unlike rate limits, these errors open the circuit breaker.
+    """
+    if isinstance(error, HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return is_transient(error)
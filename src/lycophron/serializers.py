@@ -10,25 +10,10 @@ import json
 from abc import ABC, abstractmethod
 from io import StringIO
 
+from . import codec
 from .format import Format
 
 
-class LazyReferenceJSONEncoder(json.JSONEncoder):
-    """JSON encoder that can handle LazyReference objects."""
-
-    def default(self, obj):
-        from .template import LazyReference
-
-        if isinstance(obj, LazyReference):
-            return {
-                "type": "lazy_reference",
-                "record_id": obj.record_id,
-                "field": obj.field,
-                "bidirectional": obj.bidirectional,
-            }
-        return super().default(obj)
-
-
 class SerializerFactory:
     def create_serializer(self, format):
         return self._get_serializer(format)
@@ -102,5 +87,9 @@ class JSONSerializer(Serializer):
         super().__init__()
 
     def serialize(self, data: list, **kwargs) -> str:
-        """Serialize data to JSON format with custom LazyReference encoder."""
-        return json.dumps(data, indent=4, cls=LazyReferenceJSONEncoder)
+        """Serialize data to indented JSON, see `codec` for the supported types.
+
+        Other types raise a TypeError. Exports always go through the standard
+        library, so that their format does not depend on the installed extras.
+        """
+        return json.dumps(data, indent=4, default=codec.encode)
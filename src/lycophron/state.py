@@ -0,0 +1,54 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""State shared by the processes of a project through a file."""
+
+import os
+import threading
+
+
+class StateFile:
+    """File holding a small state, e.g. the rate limit block or the breaker.
+
+    The state is written to a temporary file first and then moved in place,
+    so that the other processes never read a partial state. Reading returns
+    ``None`` when there is no file or when it has not changed since the last
+    read or write of this instance, so that callers keep their own copy.
+    Errors are ignored: the state is a hint, each process works without it.
+    """
+
+    def __init__(self, path, loads=float, dumps=repr):
+        self.path = path
+        self.loads = loads
+        self.dumps = dumps
+        self._mtime = None
+
+    def read(self):
+        """Return the state if the file changed, ``None`` otherwise."""
+        if not self.path:
+            return None
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return None
+            with open(self.path) as f:
+                state = self.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        self._mtime = mtime
+        return state
+
+    def write(self, state):
+        """Replace the state of the file."""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(self.dumps(state))
+            os.replace(tmp_path, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            pass
@@ -0,0 +1,161 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Memory-bounded streaming of the files to upload."""
+
+import mmap
+import os
+
+# Default size of the chunks handed to the socket
+CHUNK_SIZE = 1024 * 1024
+
+
+class FileStream:
+    """Read-only window of a file, streamed in fixed-size chunks.
+
+    The file is memory-mapped and each chunk is a view of the mapping, so the
+    content goes from the page cache to the socket without being copied into
+    the process. The pages of the chunks already sent are unmapped, keeping
+    the memory of the process constant whatever the size of the file.
+
+    ``read`` returns up to ``chunk_size`` bytes whatever the size requested,
+    so that the HTTP client sends large chunks rather than its small blocks.
+    If given, ``digest`` (e.g. ``hashlib.md5()``) is updated with each chunk,
+    so that the checksum is computed while sending. The next ``read_ahead``
+    chunks are read by the kernel in the background while the current one is
+    sent, so that the disk and the network are busy at the same time. Each
+    chunk waits for the bandwidth limiters in ``throttles``, if any. The
+    file is closed when leaving the ``with`` block::
+
+        with FileStream("files/data.bin") as stream:
+            session.put(url, data=stream)
+    """
+
+    mode = "rb"
+
+    def __init__(
+        self,
+        path,
+        offset=0,
+        length=None,
+        chunk_size=CHUNK_SIZE,
+        digest=None,
+        read_ahead=0,
+        throttles=(),
+    ):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.digest = digest
+        self.read_ahead = read_ahead
+        self.throttles = throttles
+        self._file = open(path, "rb")
+        size = self._size = os.fstat(self._file.fileno()).st_size
+        self.offset = min(offset, size)
+        self.length = size - self.offset if length is None else length
+        self.length = max(min(self.length, size - self.offset), 0)
+        self._position = 0
+        self._mmap = None
+        self._view = None
+        self._chunk = None
+        # End of the part of the window already read ahead
+        self._read_ahead_end = self.offset
+        if size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self._mmap, "madvise"):
+                self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+            self._view = memoryview(self._mmap)
+
+    def __len__(self):
+        return self.length - self._position
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        while chunk := self.read():
+            yield chunk
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def read(self, size=-1):
+        """Return a view of the next chunk, empty once the window is sent."""
+        self._release_chunk()
+        n = min(self.chunk_size, len(self))
+        if n <= 0:
+            return b""
+        for throttle in self.throttles:
+            throttle.consume(n)
+        start = self.offset + self._position
+        self._chunk = self._view[start : start + n]
+        self._position += n
+        self._advise_read_ahead()
+        if self.digest is not None:
+            self.digest.update(self._chunk)
+        return self._chunk
+
+    def _advise_read_ahead(self):
+        """Ask the kernel to read the next chunks while this one is sent.
+
+        Reading ahead goes past the end of the window, e.g. into the next part
+        of a multipart upload, up to the end of the file.
+        """
+        if not self.read_ahead:
+            return
+        position = self.offset + self._position
+        end = min(position + self.read_ahead * self.chunk_size, self._size)
+        if end <= self._read_ahead_end:
+            return
+        start = self._read_ahead_end
+        self._read_ahead_end = end
+        if hasattr(mmap, "MADV_WILLNEED"):
+            aligned = start - start % mmap.PAGESIZE
+            self._mmap.madvise(mmap.MADV_WILLNEED, aligned, end - aligned)
+
+    def _release_chunk(self):
+        """Release the previous chunk and unmap its pages."""
+        if self._chunk is None:
+            return
+        start = self.offset + self._position - len(self._chunk)
+        self._chunk.release()
+        self._chunk = None
+        if hasattr(mmap, "MADV_DONTNEED"):
+            aligned = start - start % mmap.PAGESIZE
+            end = self.offset + self._position
+            self._mmap.madvise(mmap.MADV_DONTNEED, aligned, end - aligned)
+
+    def close(self):
+        """Release the mapping and close the file."""
+        if self.closed:
+            return
+        self._release_chunk()
+        if self._mmap is not None:
+            self._view.release()
+            self._mmap.close()
+        self._file.close()
+
+
+def prefetch(path, length):
+    """Ask the kernel to read the start of a file ahead, without waiting.
+
+    Used for the next files to upload, so that they are in the page cache by
+    the time their upload starts.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
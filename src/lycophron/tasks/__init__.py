@@ -5,11 +5,28 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 """Lycophron tasks entry point."""
 
+import os
 import platform
 from pathlib import Path
 
 from celery import Celery
 
+STAGE_QUEUES = {
+    "create_drafts": "draft",
+    "update_metadata": "metadata",
+    "upload_files": "files",
+    "publish_records": "publish",
+}
+
+
+def _project_config():
+    """Load the config of the project in the current directory."""
+    from lycophron.config import Config
+
+    config = Config(root_path=os.getcwd(), defaults=None)
+    config.load()
+    return config
+
 
 def init_celery_app():
     """Creates a celery app."""
@@ -42,11 +59,17 @@ def init_celery_app():
         app.conf.result_backend = f"file://{str(_backend_folder)}"
     app.conf.max_memory_per_child = 100000
     app.conf.update(imports=["lycophron.tasks.tasks"])
+    # Each pipeline stage has its own queue, consumed by its own worker
+    app.conf.task_routes = {
+        f"lycophron.tasks.tasks.{task}": {"queue": queue}
+        for task, queue in STAGE_QUEUES.items()
+    }
+    # Records are dispatched on events (see `tasks.request_dispatch`), the
+    # periodic run only picks up what events missed
     app.conf.beat_schedule = {
         "record-dispathcer": {
             "task": "lycophron.tasks.tasks.record_dispatcher",
-            "schedule": 5,
-            "args": (20,),
+            "schedule": _project_config()["DISPATCH_POLL_INTERVAL"],
         },
     }
     app.conf.timezone = "UTC"
@@ -56,4 +79,4 @@ def init_celery_app():
 
 app = init_celery_app()
 
-__all__ = ["app"]
+__all__ = ["STAGE_QUEUES", "app"]
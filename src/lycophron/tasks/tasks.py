@@ -5,23 +5,47 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 """Lycophron tasks implementation."""
 
+import math
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import UTC, datetime, timedelta
-from time import sleep
-
-from inveniordm_py.files.metadata import FilesListMetadata, OutgoingStream
-from inveniordm_py.records.metadata import DraftMetadata
+from functools import partial, wraps
+from hashlib import md5
+from urllib.parse import urlsplit
+from uuid import uuid4
+
+import requests
+from celery import current_task
+from inveniordm_py.files.metadata import FilesListMetadata
 from inveniordm_py.records.resources import Draft
 from requests.exceptions import HTTPError
 
+from ..bandwidth import BandwidthLimiter, restricted_until
+from ..breaker import BreakerState
+from ..client import DraftMetadata
+from ..errors import ChecksumMismatch
 from ..logger import logger
 from ..models import File, FileStatus, Record, RecordStatus
+from ..responses import retain_response
+from ..retries import backoff, is_transient
+from ..streams import FileStream, prefetch
 from . import app
 
 type Status = RecordStatus | FileStatus
 
 
-def state_transition(frm: Status | list[Status], to: Status, err: Status):
-    """Update state of record based on event."""
+def state_transition(
+    frm: Status | list[Status], to: Status, err: Status, stage: str | None = None
+):
+    """Update state of record based on event.
+
+    Events sending requests to Zenodo give their `stage`, so that they run
+    within its adaptive concurrency limit.
+    """
 
     def update_state(event):
         def wrapper(client, obj, *args, **kwargs):
@@ -35,12 +59,19 @@ def state_transition(frm: Status | list[Status], to: Status, err: Status):
                 return
             raised = None
             try:
-                event(client, obj, *args, **kwargs)
+                with lapp.concurrency.slot(stage):
+                    event(client, obj, *args, **kwargs)
                 obj.status = to
                 obj.errors = None
             except Exception as e:
                 obj.status = err
                 raised = e
+            if isinstance(obj, Record):
+                obj.response = retain_response(
+                    obj.response,
+                    failed=raised is not None,
+                    policy=lapp.config["RESPONSE_RETENTION"],
+                )
             lapp.project.db.session.commit()
             if raised:
                 raise raised
@@ -50,10 +81,24 @@ def state_transition(frm: Status | list[Status], to: Status, err: Status):
     return update_state
 
 
+def task_session(task):
+    """Run the task in its own DB session, removed once the task is done."""
+
+    @wraps(task)
+    def wrapper(*args, **kwargs):
+        from lycophron.app import LycophronApp
+
+        with LycophronApp().project.db.task_scope():
+            return task(*args, **kwargs)
+
+    return wrapper
+
+
 @state_transition(
     frm=RecordStatus.QUEUED,
     to=RecordStatus.DRAFT_CREATED,
     err=RecordStatus.DRAFT_FAILED,
+    stage="draft",
 )
 def create_draft_record(client, record: Record):
     draft = client.records.create()
@@ -71,6 +116,7 @@ def create_draft_record(client, record: Record):
     ],
     to=RecordStatus.METADATA_UPDATED,
     err=RecordStatus.METADATA_FAILED,
+    stage="metadata",
 )
 def update_draft_metadata(client, record: Record, draft: Draft | None = None):
     """Update draft metadata with resolved references."""
@@ -94,57 +140,331 @@ def update_draft_metadata(client, record: Record, draft: Draft | None = None):
 )
 def upload_record_files(client, record: Record, draft: Draft | None = None):
     def _sync_files(record: Record, draft: Draft):
+        """Reconcile the local files with the entries listed in the draft.
+
+        All the entries are listed in a single request. Entries whose content
+        matches the local checksum are kept, uncommitted ones being committed,
+        and only the others are deleted to be uploaded again.
+        """
+        if not record.files:
+            return
+        entries = {entry["key"]: entry for entry in draft.files.get().data["entries"]}
         for local_file in record.files:
-            try:
-                rem_file = draft.files(local_file.filename).get()
-                rem_status = rem_file.data["status"]
-                if rem_status == "completed":
+            entry = entries.get(local_file.filename)
+            if entry is None:
+                local_file.status = FileStatus.TODO
+                local_file.uploaded_parts = 0
+                continue
+            same_content = _same_content(local_file, entry)
+            if same_content and entry["status"] == "completed":
+                local_file.status = FileStatus.UPLOADED
+                continue
+            remote_file = draft.files(local_file.filename)
+            if same_content:
+                # Uploaded but not committed, e.g. interrupted before commit
+                try:
+                    remote_file.commit()
                     local_file.status = FileStatus.UPLOADED
-                elif rem_status == "pending":
-                    local_file.status = FileStatus.TODO
-                    rem_file.delete()
-            except HTTPError as e:
-                if e.response.status_code == 404:
-                    local_file.status = FileStatus.TODO
-            except Exception as e:
-                logger.debug(f"Error getting remote file {local_file.filename=}: {e=}")
-                raise
+                    continue
+                except HTTPError as e:
+                    logger.debug(f"Error committing {local_file.filename=}: {e=}")
+            local_file.status = FileStatus.TODO
+            if local_file.uploaded_parts and _is_multipart(entry):
+                # Interrupted multipart upload, resumed from its last part
+                continue
+            local_file.uploaded_parts = 0
+            remote_file.delete()
+
+    from lycophron.app import LycophronApp
 
     if draft is None:
         draft = client.records(record.upload_id).draft.get()
 
     _sync_files(record, draft)
-    files = record.files
+    files = [f for f in record.files if f.status == FileStatus.TODO]
+    if not files:
+        return
+    # Files waiting for a thread are read ahead while the first ones upload
+    _prefetch_files(files)
+    # Files are sent from threads, bounded per record here and overall by the
+    # concurrency limit of the stage, while their status is updated and
+    # committed from this thread only, which owns the DB session
+    lapp = LycophronApp()
+    max_workers = min(lapp.config["FILE_UPLOAD_CONCURRENCY"], len(files))
+    # Caps may have changed since the last record, see `Config.reload_if_changed`
+    lapp.upload_bandwidth.rate = lapp.config["UPLOAD_BANDWIDTH"]
+    throttles = (
+        lapp.upload_bandwidth,
+        BandwidthLimiter(lapp.config["UPLOAD_BANDWIDTH_PER_WORKER"]),
+    )
+    progress = queue.Queue()
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        sent = {
+            pool.submit(
+                _send_file,
+                draft,
+                f.filename,
+                uploaded_parts=f.uploaded_parts or 0,
+                on_part=partial(_put_progress, progress, f),
+                throttles=throttles,
+            ): f
+            for f in files
+        }
+        running = set(sent)
+        while running:
+            done, running = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+            _save_progress(progress)
+            for future in done:
+                try:
+                    upload_file(client, sent[future], draft, sent=future)
+                except Exception as e:
+                    error = error or e
+    # The record is only uploaded once all its files are
+    if error:
+        raise error
+
+
+def _prefetch_files(files):
+    """Ask the kernel to read the start of the given files ahead."""
+    from lycophron.app import LycophronApp
+
+    config = LycophronApp().config
+    length = config["UPLOAD_CHUNK_SIZE"] * config["UPLOAD_READ_AHEAD"]
+    if not length:
+        return
     for f in files:
-        if f.status == FileStatus.UPLOADED:
-            continue
+        prefetch(f"files/{f.filename}", length)
+
+
+def _put_progress(progress: queue.Queue, file: File, uploaded_parts: int):
+    progress.put((file, uploaded_parts))
+
+
+def _save_progress(progress: queue.Queue):
+    """Record the parts sent by the upload threads."""
+    from lycophron.app import LycophronApp
+
+    updated = False
+    while not progress.empty():
+        file, uploaded_parts = progress.get()
+        file.uploaded_parts = uploaded_parts
+        updated = True
+    if updated:
+        LycophronApp().project.db.session.commit()
+
+
+@state_transition(frm=FileStatus.TODO, to=FileStatus.UPLOADED, err=FileStatus.FAILED)
+def upload_file(client, file: File, draft: Draft, sent: Future | None = None):
+    """Upload a file to the draft.
+
+    ``sent`` is the future of the file already being sent by `_send_file`, in
+    which case only its outcome is recorded. The checksum computed while
+    sending is stored if it was not computed when loading the file, or must
+    match the stored one otherwise.
+    """
+    if sent is None:
+        checksum = _send_file(draft, file.filename)
+    else:
+        checksum = sent.result()
+    if checksum is None:
+        return
+    if file.checksum is None:
+        file.checksum = checksum
+    elif file.checksum != checksum:
+        raise ChecksumMismatch(
+            message=f"File {file.filename} changed since it was loaded."
+        )
+
+
+def _send_file(
+    draft: Draft, filename: str, uploaded_parts=0, on_part=None, throttles=()
+):
+    """Send a file to the draft, without touching the DB.
+
+    An upload rejected because of a pending entry, e.g. left by an interrupted
+    upload, is sent again once the entry is deleted.
+
+    :param uploaded_parts: parts of a multipart upload already sent
+    :param on_part: called with the number of parts sent after each part
+    :param throttles: bandwidth limiters of the upload
+    :return: the checksum of the content sent, None if it was already there
+    """
+    from lycophron.app import LycophronApp
+
+    on_part = on_part or (lambda uploaded_parts: None)
+    with LycophronApp().concurrency.slot("files"):
         try:
-            upload_file(client, f, draft)
+            return _send_file_contents(
+                draft, filename, uploaded_parts, on_part, throttles
+            )
         except HTTPError as e:
-            if e.response.status_code == 400:
-                if check_file_status(f.filename, draft) in [
-                    "pending"
-                ]:  # TODO Add status of error
-                    draft.files(f.filename).delete()
-                    upload_file(client, f, draft)  # TODO Configure number of retries
-            else:
+            if e.response is None or e.response.status_code != 400:
                 raise
+            status = check_file_status(filename, draft)
+            if status == "completed":
+                return None
+            if status != "pending":
+                raise
+            draft.files(filename).delete()
+            on_part(0)
+            return _send_file_contents(draft, filename, 0, on_part, throttles)
 
 
-@state_transition(frm=FileStatus.TODO, to=FileStatus.UPLOADED, err=FileStatus.FAILED)
-def upload_file(client, file: File, draft: Draft):
-    logger.debug(f"Uploading file {file.filename=}")
+def _send_file_contents(
+    draft: Draft, filename: str, uploaded_parts, on_part, throttles=()
+):
+    """Send the content of a file, computing its checksum on the way.
+
+    The checksum is checked against the one computed by Zenodo, so that each
+    byte is read once to be both sent and verified. Remote checksums of other
+    schemes, e.g. the ETags of multipart uploads on some storages, cannot be
+    compared and are ignored.
+    """
+    from lycophron.app import LycophronApp
+
+    logger.debug(f"Uploading file {filename=}")
+    path = f"files/{filename}"  # TODO Hardcoded path, should be configurable?
+    config = LycophronApp().config
+    digest = md5()
+    stream_options = {
+        "chunk_size": config["UPLOAD_CHUNK_SIZE"],
+        "digest": digest,
+        "read_ahead": config["UPLOAD_READ_AHEAD"],
+        "throttles": throttles,
+    }
+    size = os.path.getsize(path)
+    entry = None
+    if size > config["MULTIPART_THRESHOLD"]:
+        if uploaded_parts:
+            entry = draft.files(filename).get().data
+        else:
+            entry = _create_multipart_entry(
+                draft, filename, size, config["MULTIPART_PART_SIZE"]
+            )
+    if entry is not None:
+        _send_parts(
+            draft, filename, path, entry, uploaded_parts, on_part, stream_options
+        )
+    else:
+        file_data = FilesListMetadata(
+            [{"key": filename}]
+        )  # TODO Cannot use FileMetadata for somereason
+        draft.files.create(file_data)
+        with FileStream(path, **stream_options) as stream:
+            _put_content(draft, draft.files(filename).url("/content"), stream)
+    res = draft.files(filename).commit()
+    checksum = f"md5:{digest.hexdigest()}"
+    try:
+        remote_checksum = res.data["checksum"]
+    except (KeyError, TypeError):
+        remote_checksum = None
+    if (
+        isinstance(remote_checksum, str)
+        and remote_checksum.startswith("md5:")
+        and remote_checksum != checksum
+    ):
+        raise ChecksumMismatch(
+            message=f"File {filename} was corrupted during the upload: "
+            f"{remote_checksum} on Zenodo, {checksum} sent."
+        )
+    return checksum
+
+
+def _create_multipart_entry(draft: Draft, filename: str, size: int, part_size: int):
+    """Create the entry of a multipart upload.
+
+    Return None if the storage backend does not support multipart uploads.
+    """
+    parts = math.ceil(size / part_size)
     file_data = FilesListMetadata(
-        [{"key": file.filename}]
-    )  # TODO Cannot use FileMetadata for somereason
-    # TODO if the file already exists on remote, don't try to upload
-    # TODO e.g. check checksum
-    draft.files.create(file_data)
-    stream = open(
-        f"files/{file.filename}", "rb"
-    )  # TODO Hardcoded path, should be configurable?
-    draft.files(file.filename).set_contents(OutgoingStream(data=stream))
-    draft.files(file.filename).commit()  # TODO Add retry on upload?
+        [
+            {
+                "key": filename,
+                "size": size,
+                "transfer": {"type": "M", "parts": parts, "part_size": part_size},
+            }
+        ]
+    )
+    try:
+        res = draft.files.create(file_data)
+    except HTTPError as e:
+        if e.response is None or e.response.status_code != 400:
+            raise
+        logger.debug(f"Multipart upload not supported for {filename=}: {e=}")
+        return None
+    for entry in res.data["entries"]:
+        if entry["key"] == filename:
+            return entry
+    return None
+
+
+def _is_multipart(entry) -> bool:
+    return (entry.get("transfer") or {}).get("type") == "M"
+
+
+def _send_parts(
+    draft: Draft, filename, path, entry, uploaded_parts, on_part, stream_options
+):
+    """Send the parts of a multipart upload, from the first one not sent.
+
+    The parts sent before an interruption are read again for the checksum.
+
+    :param stream_options: keyword arguments of the `FileStream` of each part
+    """
+    transfer = entry["transfer"]
+    part_size = transfer["part_size"]
+    try:
+        part_urls = {link["part"]: link["url"] for link in entry["links"]["parts"]}
+    except KeyError:
+        part_urls = {}
+    remote_file = draft.files(filename)
+    if uploaded_parts:
+        sent_length = uploaded_parts * part_size
+        # Only read for the checksum, not sent
+        options = {**stream_options, "throttles": ()}
+        with FileStream(path, 0, sent_length, **options) as stream:
+            for _ in stream:
+                pass
+    for part in range(uploaded_parts + 1, transfer["parts"] + 1):
+        url = part_urls.get(part) or remote_file.url(f"/content/{part}")
+        offset = (part - 1) * part_size
+        with FileStream(path, offset, part_size, **stream_options) as stream:
+            _put_content(draft, url, stream)
+        on_part(part)
+
+
+def _origin(url):
+    parts = urlsplit(url)
+    return parts.scheme.lower(), parts.netloc.lower()
+
+
+def _put_content(draft: Draft, url, data):
+    """Send the contents of a file, or of one of its parts.
+
+    ``DraftFile.set_contents`` form-encodes the stream wrapped in an
+    ``OutgoingStream``, so the body is sent as is with the draft's session.
+    Streams are sent chunk by chunk, with their length as ``Content-Length``.
+    URLs on another origin than Zenodo, e.g. presigned URLs of the parts on
+    the storage, get a plain request, without the token of the session.
+    """
+    headers = {"Content-Type": "application/octet-stream"}
+    if _origin(url) == _origin(draft.url()):
+        res = draft.session.put(url, data=data, headers=headers)
+    else:
+        timeout = getattr(draft.session, "timeout", None)
+        res = requests.put(url, data=data, headers=headers, timeout=timeout)
+    res.raise_for_status()
+
+
+def _same_content(file: File, entry) -> bool:
+    """Whether a remote file entry has the content of the local file.
+
+    Completed entries are trusted when there is no local checksum to compare.
+    """
+    if not file.checksum:
+        return entry["status"] == "completed"
+    return entry.get("checksum") == file.checksum
 
 
 def check_file_status(filename, draft: Draft):
@@ -157,6 +477,7 @@ def check_file_status(filename, draft: Draft):
     frm=RecordStatus.FILE_UPLOADED,
     to=RecordStatus.PUBLISHED,
     err=RecordStatus.PUBLISH_FAILED,
+    stage="publish",
 )
 def publish_record(client, record: Record, draft: Draft | None = None):
     draft = draft or client.records(record.upload_id).draft
@@ -176,102 +497,366 @@ def add_to_community(client, record: Record, published_record=None):
     # TODO implement add to community, and use Community Table
 
 
-@app.task
-def process_record(record_id):
+# Status reached by a record when each stage succeeds, in pipeline order
+STAGE_STATUSES = {
+    "draft": RecordStatus.DRAFT_CREATED,
+    "metadata": RecordStatus.METADATA_UPDATED,
+    "files": RecordStatus.FILE_UPLOADED,
+    "publish": RecordStatus.PUBLISHED,
+}
+
+# Draft creation does not chain: all records need a DOI before their metadata,
+# with cross-references, is sent
+NEXT_STAGES = {"metadata": "files", "files": "publish"}
+
+
+def _run_step(client, record: Record, stage):
+    if stage == "draft":
+        create_draft_record(client, record)
+        return
+    draft = client.records(record.upload_id).draft
+    if stage == "metadata":
+        update_draft_metadata(client, record, draft=draft)
+    elif stage == "files":
+        upload_record_files(client, record, draft=draft)
+    elif stage == "publish":
+        publish_record(client, record, draft=draft)
+        # add_to_community(client, record)
+
+
+def _upload_restricted_until(lapp):
+    """Return when uploads are allowed again, None if they are now."""
+    lapp.config.reload_if_changed()
+    until = restricted_until(lapp.config["UPLOAD_RESTRICTED_HOURS"])
+    return until and until.astimezone(UTC).replace(tzinfo=None)
+
+
+def _error_body(response):
+    """Get the body of an error response, which may not be JSON (e.g. a 502)."""
+    try:
+        return response.json()
+    except ValueError:
+        return {"status": response.status_code, "message": response.text[:1000]}
+
+
+def _schedule_retry(lapp, record: Record, status: Status):
+    """Schedule the next attempt of a record after a transient error."""
+    config = lapp.config
+    delay = backoff(
+        record.attempt_count or 0,
+        base=config["RETRY_BACKOFF"],
+        cap=config["RETRY_BACKOFF_MAX"],
+    )
+    # Do not come back before Zenodo accepts requests again
+    delay = max(delay, lapp.rate_limiter.blocked_for())
+    # The step set the failed status, restore it to run the step again
+    record.status = status
+    record.attempt_count = (record.attempt_count or 0) + 1
+    record.next_attempt_at = datetime.now(UTC).replace(tzinfo=None) + timedelta(
+        seconds=delay
+    )
+    logger.info(
+        f"Retrying record {record.id=} in {delay:.0f}s (attempt {record.attempt_count})"
+    )
+
+
+def run_stage(record: Record, stage) -> bool:
+    """Run a stage of the pipeline for a record.
+
+    Transient errors (see `retries.is_transient`) schedule a later attempt of
+    the stage, until ``RETRY_MAX_ATTEMPTS`` is reached, as do an open circuit
+    breaker and, for the files stage, the restricted upload hours. Other
+    errors leave the record failed, with the error or response stored in the
+    record.
+
+    :return: whether the record went through the stage
+    :rtype: bool
+    """
     from lycophron.app import LycophronApp
 
     lapp = LycophronApp()
-    db_record = lapp.project.db.get_record(record_id)
-    client = lapp.client
+    db = lapp.project.db
+    if stage == "files" and (resume_at := _upload_restricted_until(lapp)):
+        # Uploads wait for the end of the restricted hours
+        record.next_attempt_at = resume_at
+        db.session.commit()
+        return False
+    if not lapp.breaker.allow():
+        # Zenodo is unavailable, come back once the breaker lets calls through
+        record.next_attempt_at = datetime.now(UTC).replace(tzinfo=None) + timedelta(
+            seconds=max(lapp.breaker.retry_after(), 1)
+        )
+        db.session.commit()
+        return False
+    budget = lapp.stage_rate_limiters.get(stage)
+    status = record.status
+    if budget:
+        budget.acquire()
+    try:
+        _run_step(lapp.client, record, stage)
+    except Exception as e:
+        lapp.breaker.record(e)
+        logger.error(f"Error in stage {stage} of record {record.id=}: {e=}")
+        if isinstance(e, HTTPError):
+            if e.response.status_code == 429:
+                lapp.rate_limiter.update(e.response)
+            record.response = _error_body(e.response)
+        else:
+            record.error = str(e)
+        retry = is_transient(e) and (
+            (record.attempt_count or 0) < lapp.config["RETRY_MAX_ATTEMPTS"]
+        )
+        if retry:
+            _schedule_retry(lapp, record, status)
+        db.session.commit()
+        if retry or isinstance(e, HTTPError):
+            return False
+        raise
+    if lapp.breaker.record():
+        logger.info("Zenodo is available again, resuming the publication")
+        if current_task:
+            # Only in a worker, the in-process executors have no dispatcher
+            request_dispatch()
+    if record.attempt_count or record.next_attempt_at:
+        record.attempt_count = 0
+        record.next_attempt_at = None
+        db.session.commit()
+    return record.status == STAGE_STATUSES[stage]
+
+
+@app.task
+@task_session
+def process_record(record_id, stages=None):
+    """Run the stages of a record.
+
+    :param stages: stages to run, in pipeline order, defaults to all of them;
+        draft creation is skipped for records that already have a draft
+    """
+    from lycophron.app import LycophronApp
+
+    db = LycophronApp().project.db
+    db_record = db.get_record(record_id)
     logger.debug(f"Processing record {record_id=}")
     if not db_record:
         logger.error(f"Record {record_id} not found in the database.")
         return
 
-    # Process only draft creation in this phase
-    # This allows all records to have pre-reserved DOIs before we update metadata
-    # with cross-references
-    if db_record.upload_id is None:
-        while True:
+    for stage in stages or STAGE_STATUSES:
+        if stage == "draft" and db_record.upload_id is not None:
+            # Draft creation pre-reserves the DOI, only once
+            continue
+        if not run_stage(db_record, stage):
+            return
+
+
+@contextmanager
+def _keep_lease(record_id, lease, ttl):
+    """Renew the lease of a record while the block runs.
+
+    The lease is renewed every third of ``ttl`` from a thread with its own
+    session, so that a stage running for longer than ``ttl``, e.g. uploading
+    large files, keeps its record.
+    """
+    if not lease:
+        yield
+        return
+    from lycophron.app import LycophronApp
+
+    db = LycophronApp().project.db
+    done = threading.Event()
+
+    def renew():
+        while not done.wait(ttl / 3):
             try:
-                draft = create_draft_record(client, db_record)
-                break
-            except HTTPError as e:
-                logger.error(f"Error creating draft for record {db_record.id=}: {e=}")
-                if e.response.status_code == 429:
-                    sleep(60)
-                    continue
-                else:
-                    db_record.response = e.response.json()
-                    lapp.project.db.session.commit()
-                    return
+                with db.task_scope():
+                    if not db.renew_lease(record_id, lease, ttl):
+                        logger.warning(f"Lease of record {record_id=} lost")
+                        return
             except Exception as e:
-                logger.error(f"Error creating draft for record {db_record.id=}: {e=}")
-                db_record.error = str(e)
-                lapp.project.db.session.commit()
-                raise
+                logger.error(f"Error renewing the lease of {record_id=}: {e=}")
 
-    # Continue with the rest of the processing
-    while True:
-        try:
-            draft = client.records(db_record.upload_id).draft
-            update_draft_metadata(client, db_record, draft=draft)
-            upload_record_files(client, db_record, draft=draft)
-            publish_record(client, db_record, draft=draft)
-            # add_to_community(client, db_record)
-        except HTTPError as e:
-            logger.error(f"Error processing record {db_record.id=}: {e=}")
-            if e.response.status_code == 429:
-                sleep(60)
-                continue
-            else:
-                db_record.response = e.response.json()
-                lapp.project.db.session.commit()
-        except Exception as e:
-            logger.error(f"Error processing record {db_record.id=}: {e=}")
-            db_record.error = str(e)
-            lapp.project.db.session.commit()
-            raise
-        break
+    thread = threading.Thread(target=renew, name="lycophron-lease", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
 
 
-@app.task
-def record_dispatcher(num_records=10):
+def process_stage(stage, record_ids, lease=None):
+    """Run a stage for a chunk of records, each one in its own session.
+
+    A failing record does not stop the rest of the chunk. Records that went
+    through the stage are sent together to the next one, the lease of the
+    others is released. The lease is extended when a record starts each
+    stage, as it may have waited in the queues for longer than ``LEASE_TTL``;
+    records whose lease was taken over meanwhile are left to their new owner.
+    It is then renewed while the stage runs, see `_keep_lease`.
+
+    :param lease: owner of the records' lease, see `record_dispatcher`
+    """
     from lycophron.app import LycophronApp
 
     lapp = LycophronApp()
     db = lapp.project.db
-    records = db.get_unpublished_deposits(num_records)
-    # TODO why we need this?
-    retry_time = lapp.config.get("RETRY_IGNORE_TIME")
+    next_stage = NEXT_STAGES.get(stage)
+    succeeded = []
+    # Time spent on the records of the chunk, observed once at the end
+    elapsed = 0.0
+    n_records = 0
+    for i, record_id in enumerate(record_ids):
+        start = time.monotonic()
+        with db.task_scope():
+            passed = False
+            if lease and not db.renew_lease(record_id, lease, lapp.config["LEASE_TTL"]):
+                logger.warning(f"Lease of record {record_id=} lost, skipping it")
+                continue
+            try:
+                if stage == "files" and i + 1 < len(record_ids):
+                    # Read the files of the next record ahead during this one
+                    next_record = db.get_record(record_ids[i + 1])
+                    if next_record is not None:
+                        _prefetch_files(next_record.files)
+                record = db.get_record(record_id)
+                if record is None:
+                    logger.error(f"Record {record_id} not found in the database.")
+                else:
+                    with _keep_lease(record_id, lease, lapp.config["LEASE_TTL"]):
+                        passed = run_stage(record, stage)
+            except Exception as e:
+                logger.error(f"Error processing record {record_id=}: {e=}")
+                db.session.rollback()
+            if passed and next_stage:
+                succeeded.append(record_id)
+            elif lease:
+                db.release_lease(record_id, lease)
+        elapsed += time.monotonic() - start
+        n_records += 1
 
-    # Process records in two phases:
-    # 1. First ensure all NEW records are queued for draft creation
-    # 2. Then process all records that have drafts created for metadata updates
-    todo_records = [r for r in records if r.status == RecordStatus.TODO]
+    if n_records:
+        lapp.chunk_size.observe(elapsed / n_records, records=n_records)
+    if succeeded:
+        STAGE_TASKS[next_stage].delay(succeeded, lease=lease)
+    if len(succeeded) < len(record_ids):
+        # Some records left the pipeline, e.g. after draft creation, so the
+        # next phase may be ready to start
+        request_dispatch()
 
-    # Count records that need draft creation (new records)
-    new_records = todo_records
 
-    # Phase 1: Queue all new records for draft creation first
-    for record in new_records:
-        record.status = RecordStatus.QUEUED
-        db.session.commit()
-        process_record.delay(record.id)
+@app.task(ignore_result=True)
+def create_drafts(record_ids, lease=None):
+    """Create the drafts of a chunk of records, see `process_stage`."""
+    process_stage("draft", record_ids, lease=lease)
+
+
+@app.task(ignore_result=True)
+def update_metadata(record_ids, lease=None):
+    """Update the draft metadata of a chunk of records, see `process_stage`."""
+    process_stage("metadata", record_ids, lease=lease)
+
+
+@app.task(ignore_result=True)
+def upload_files(record_ids, lease=None):
+    """Upload the files of a chunk of records, see `process_stage`."""
+    process_stage("files", record_ids, lease=lease)
+
+
+@app.task(ignore_result=True)
+def publish_records(record_ids, lease=None):
+    """Publish a chunk of records, see `process_stage`."""
+    process_stage("publish", record_ids, lease=lease)
 
-    # If any new records are being processed, return and let them finish first
-    # This ensures all records have DOIs before processing metadata with references
-    if new_records:
-        return
 
-    # Phase 2: Process all records that already have drafts created
-    for record in records:
-        if record.failed:
-            # When a record is failed, something has to be done first
+# Task of each stage, routed to the queue of the same name (see `init_celery_app`)
+STAGE_TASKS = {
+    "draft": create_drafts,
+    "metadata": update_metadata,
+    "files": upload_files,
+    "publish": publish_records,
+}
+
+
+def request_dispatch():
+    """Ask the worker to dispatch records, after an event that may make some
+    ready (records loaded, retried or leaving the pipeline).
+    """
+    record_dispatcher.delay()
+
+
+@app.task
+@task_session
+def record_dispatcher(num_records=None):
+    from lycophron.app import LycophronApp
+
+    lapp = LycophronApp()
+    db = lapp.project.db
+    num_records = num_records or lapp.config["DISPATCH_BATCH_SIZE"]
+    breaker_state = lapp.breaker.state
+    if breaker_state == BreakerState.OPEN:
+        logger.info("Zenodo is unavailable, dispatch is paused")
+        return
+    if breaker_state == BreakerState.HALF_OPEN:
+        # Probe Zenodo with a single record, its success resumes the dispatch
+        num_records = 1
+    # Records already enqueued hold a lease until their last stage is done (or
+    # until it expires, if the worker crashed), so they are not returned here.
+    # TODO why we need this?
+    retry_time = lapp.config.get("RETRY_IGNORE_TIME")
+    updated_after = None
+    if retry_time:
+        updated_after = datetime.now(UTC).replace(tzinfo=None) - timedelta(
+            seconds=retry_time
+        )
+
+    # Process records in two phases, so that all records have DOIs before
+    # metadata with references is sent:
+    # 1. First queue all the records without a draft for draft creation
+    # 2. Then, once no draft is pending, process the records with a draft
+    to_dispatch = db.get_dispatchable_records(
+        num_records, updated_after=updated_after, drafted=False
+    )
+    if not to_dispatch:
+        if db.has_pending_drafts(updated_after=updated_after):
+            # Drafts still queued or retried, the last one triggers a dispatch
+            logger.debug("Waiting for the pending drafts before sending metadata")
+            return
+        to_dispatch = db.get_dispatchable_records(
+            num_records, updated_after=updated_after, drafted=True
+        )
+
+    lease = uuid4().hex
+    leased = set(
+        db.lease_records([r.id for r in to_dispatch], lease, lapp.config["LEASE_TTL"])
+    )
+    record_ids = {"draft": [], "metadata": [], "files": []}
+    for record in to_dispatch:
+        if record.id not in leased:
+            # Enqueued in the meantime by another dispatcher
             continue
-        elif retry_time and (
-            datetime.now(UTC) - record.updated.replace(tzinfo=UTC)
-        ) > timedelta(seconds=retry_time):
+        if record.status == RecordStatus.TODO:
+            record.status = RecordStatus.QUEUED
+        if record.upload_id is None:
+            stage = "draft"
+        elif record.status == RecordStatus.METADATA_UPDATED:
+            # E.g. deferred by the restricted upload hours
+            stage = "files"
+        else:
+            stage = "metadata"
+        record_ids[stage].append(record.id)
+    db.session.commit()
+    if len(leased) == num_records and breaker_state == BreakerState.CLOSED:
+        # There may be more records ready, do not wait for the next event
+        record_dispatcher.delay(num_records)
+
+    # One message per chunk rather than per record, to save broker I/O. The
+    # records of a chunk run one after another, so a batch is spread over at
+    # least as many chunks as the stage's worker has threads
+    chunk_size = lapp.chunk_size.size
+    limits = lapp.config["CONCURRENCY_LIMITS"]
+    for stage, ids in record_ids.items():
+        if not ids:
             continue
-
-        process_record.delay(record.id)
+        size = min(chunk_size, math.ceil(len(ids) / limits.get(stage, 1)))
+        for i in range(0, len(ids), size):
+            STAGE_TASKS[stage].delay(ids[i : i + size], lease=lease)
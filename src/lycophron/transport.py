@@ -0,0 +1,170 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""HTTP/2 transport of the client.
+
+The requests of the client are sent by an `httpx <https://www.python-httpx.org>`_
+client when ``HTTP_TRANSPORT`` is ``"httpx"``, installed with
+``pip install lycophron[http2]``. The draft, file and publish operations are
+unchanged, only the connections under them are.
+"""
+
+import os
+import ssl
+import threading
+import time
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .client import IDEMPOTENT_METHODS, RETRY_STATUS_CODES, mount_transport
+from .errors import ConfigError
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class HTTPXAdapter(BaseAdapter):
+    """Sends the requests of a session with httpx, over HTTP/2 when possible.
+
+    All the threads of the worker share at most ``pool_size`` connections:
+    over HTTP/2, negotiated with the servers supporting it, each connection
+    multiplexes the requests of many threads, so a few connections and TLS
+    handshakes serve all the records processed at the same time. Each thread
+    still waits for its own requests, the adapter saves connections, not
+    threads.
+
+    Streamed requests, i.e. file uploads, are sent by ``fallback`` instead: a
+    large upload would hold back the requests multiplexed with it.
+    Idempotent requests are retried up to ``retries`` times on connection
+    errors and server errors, as with `mount_transport`.
+    """
+
+    def __init__(
+        self, pool_size, retries=0, backoff_factor=0.5, fallback=None, http2=True
+    ):
+        if httpx is None:
+            raise ConfigError(
+                message="The httpx transport requires the http2 extra: "
+                "pip install lycophron[http2]"
+            )
+        super().__init__()
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.fallback = fallback
+        self.http2 = http2
+        # One client per way of verifying certificates
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def send(
+        self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None
+    ):
+        """Send a prepared request, see `requests.adapters.BaseAdapter`."""
+        if stream or not isinstance(request.body, str | bytes | None):
+            return self.fallback.send(
+                request,
+                stream=stream,
+                timeout=timeout,
+                verify=verify,
+                cert=cert,
+                proxies=proxies,
+            )
+        try:
+            return self.build_response(request, self._send(request, timeout, verify))
+        except httpx.ConnectTimeout as e:
+            raise requests.exceptions.ConnectTimeout(e, request=request) from e
+        except httpx.ReadTimeout as e:
+            raise requests.exceptions.ReadTimeout(e, request=request) from e
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request) from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request) from e
+
+    def _send(self, request, timeout, verify):
+        client = self._client(verify)
+        retries = self.retries if request.method in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            try:
+                response = client.request(
+                    request.method,
+                    request.url,
+                    headers=dict(request.headers),
+                    content=request.body,
+                    timeout=_timeout(timeout),
+                )
+            except httpx.TransportError:
+                if attempt == retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                    return response
+            time.sleep(self.backoff_factor * 2**attempt)
+
+    def _client(self, verify):
+        with self._lock:
+            client = self._clients.get(verify)
+            if client is None:
+                limits = httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                )
+                client = self._clients[verify] = httpx.Client(
+                    http2=self.http2, limits=limits, verify=_ssl_context(verify)
+                )
+            return client
+
+    def build_response(self, request, resp):
+        """Build a `requests.Response` from an httpx response."""
+        response = requests.Response()
+        response.status_code = resp.status_code
+        response.headers = CaseInsensitiveDict(resp.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = resp.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response._content = resp.content
+        return response
+
+    def close(self):
+        """Close the connections."""
+        if self.fallback is not None:
+            self.fallback.close()
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+def _timeout(timeout):
+    """Convert a timeout of `requests`, e.g. ``(connect, read)``, for httpx."""
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return httpx.Timeout(timeout)
+
+
+def _ssl_context(verify):
+    """Convert the ``verify`` of `requests` for httpx: bool or CA bundle."""
+    if not isinstance(verify, str):
+        return verify
+    if os.path.isdir(verify):
+        return ssl.create_default_context(capath=verify)
+    return ssl.create_default_context(cafile=verify)
+
+
+def mount_http2_transport(session, pool_size, retries=0, backoff_factor=0.5):
+    """Mount an `HTTPXAdapter`, uploads going through `mount_transport`."""
+    fallback = mount_transport(session, pool_size, retries, backoff_factor)
+    adapter = HTTPXAdapter(pool_size, retries, backoff_factor, fallback=fallback)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return adapter
@@ -5,7 +5,15 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 """Test fixtures for Lycophron."""
 
+from unittest.mock import MagicMock
+
 import pytest
+import requests
+from click.testing import CliRunner
+
+from lycophron.app import LycophronApp
+from lycophron.cli import lycophron
+from lycophron.models import RecordStatus
 
 
 @pytest.fixture(autouse=True)
@@ -23,3 +31,78 @@ def reset_singleton():
 
     # Restore original instances after test
     SingletonMeta._instances = original_instances
+
+
+class FakeResource:
+    """In-memory stand-in for the record, draft and file resources."""
+
+    def __init__(self, client, data=None):
+        self._client = client
+        self.data = data or {}
+
+    def create(self, data=None):
+        self._client.calls.append("create")
+        record_id = str(len(self._client.calls))
+        return FakeResource(self._client, {"id": record_id, "status": "draft"})
+
+    def update(self, data=None):
+        self._client.calls.append("update")
+        return FakeResource(self._client, {"id": "1", "metadata": {}})
+
+    def publish(self):
+        self._client.calls.append("publish")
+        return FakeResource(self._client, {"id": "1", "status": "published"})
+
+    @property
+    def draft(self):
+        return self
+
+    def __call__(self, *args):
+        return self
+
+
+class FakeClient:
+    """In-memory stand-in for the InvenioRDM client."""
+
+    def __init__(self):
+        self.calls = []
+        self.records = FakeResource(self)
+
+
+@pytest.fixture
+def fake_client():
+    """Client that records the API calls instead of sending them."""
+    return FakeClient()
+
+
+@pytest.fixture
+def http_error():
+    """Factory of the HTTP errors raised by the client, e.g. ``http_error(503)``."""
+
+    def _http_error(status_code, **headers):
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers.update(headers)
+        response._content = b"<html>Bad gateway</html>"
+        return requests.HTTPError(response=response)
+
+    return _http_error
+
+
+@pytest.fixture
+def init_project():
+    """Factory initializing a project with one record per given status."""
+
+    def _init_project(statuses, client=None):
+        CliRunner().invoke(lycophron, ["init"])
+        app = LycophronApp()
+        app.client = client or MagicMock()
+        for i, status in enumerate(statuses):
+            app.project.db.add_record({"id": f"record{i}", "input_metadata": {}})
+            record = app.project.db.get_record(f"record{i}")
+            record.status = status
+            record.upload_id = None if status == RecordStatus.TODO else f"draft{i}"
+            app.project.db.session.commit()
+        return app
+
+    return _init_project
@@ -0,0 +1,89 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the bandwidth caps and the restricted upload hours."""
+
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+
+from lycophron.bandwidth import BandwidthLimiter, parse_window, restricted_until
+from lycophron.errors import InvalidConfig
+
+CET = timezone(timedelta(hours=1))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_bandwidth_limiter():
+    """Test that the bytes consumed follow the rate, after the burst."""
+    clock = FakeClock()
+    with patch("lycophron.bandwidth.time", clock):
+        limiter = BandwidthLimiter(rate=1000, burst=1.0)
+        clock.sleep(10)
+        # The bucket is full after being idle, but not more
+        limiter.consume(1000)
+        assert clock.now == 10
+        for _ in range(10):
+            limiter.consume(500)
+        assert clock.now == pytest.approx(15)
+
+
+def test_bandwidth_limiter_rate_change():
+    """Test that the rate applies as soon as it changes, 0 being unlimited."""
+    clock = FakeClock()
+    with patch("lycophron.bandwidth.time", clock):
+        limiter = BandwidthLimiter()
+        limiter.consume(10**9)
+        assert clock.now == 0
+        limiter.rate = 100
+        limiter.consume(200)
+        assert clock.now == pytest.approx(2)
+
+
+def test_parse_window():
+    """Test the windows, with or without days."""
+    assert parse_window("08:00-18:00") == (set(range(7)), 480, 1080)
+    assert parse_window("Mon-Fri 08:00-18:00") == ({0, 1, 2, 3, 4}, 480, 1080)
+    assert parse_window("fri-mon 22:00-6:00") == ({4, 5, 6, 0}, 1320, 360)
+    assert parse_window("sat,sun 00:00-24:00") == ({5, 6}, 0, 1440)
+    for spec in ["8-18", "mon-xyz 08:00-18:00", "08:00-25:00", "08:61-09:00"]:
+        with pytest.raises(InvalidConfig):
+            parse_window(spec)
+
+
+@pytest.mark.parametrize(
+    ("specs", "now", "until"),
+    [
+        (["mon-fri 08:00-18:00"], datetime(2024, 1, 1, 10), datetime(2024, 1, 1, 18)),
+        (["mon-fri 08:00-18:00"], datetime(2024, 1, 1, 18), None),
+        (["mon-fri 08:00-18:00"], datetime(2024, 1, 6, 10), None),
+        (["22:00-06:00"], datetime(2024, 1, 2, 23), datetime(2024, 1, 3, 6)),
+        (["22:00-06:00"], datetime(2024, 1, 2, 5), datetime(2024, 1, 2, 6)),
+        (["fri 22:00-06:00"], datetime(2024, 1, 6, 5), datetime(2024, 1, 6, 6)),
+        (["fri 22:00-06:00"], datetime(2024, 1, 2, 5), None),
+        (
+            ["08:00-12:00", "12:00-18:00"],
+            datetime(2024, 1, 1, 9),
+            datetime(2024, 1, 1, 18),
+        ),
+        ([], datetime(2024, 1, 1, 9), None),
+    ],
+)
+def test_restricted_until(specs, now, until):
+    """Test the end of the restricted window we are in, on 2024-01-01 (Monday)."""
+    now = now.replace(tzinfo=CET)
+    until = until and until.replace(tzinfo=CET)
+    assert restricted_until(specs, now) == until
@@ -0,0 +1,66 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the circuit breaker."""
+
+import os
+import tempfile
+from unittest.mock import patch
+
+from requests.exceptions import ConnectionError
+
+from lycophron.breaker import BreakerState, CircuitBreaker
+
+
+def test_breaker_opens_on_outage(http_error):
+    """Test that the breaker opens when enough calls fail, then probes."""
+    breaker = CircuitBreaker(threshold=0.5, window=4, min_calls=4, cooldown=30)
+    for error in [None, http_error(503), ConnectionError(), None]:
+        assert breaker.allow()
+        breaker.record(error)
+    assert breaker.state == BreakerState.OPEN
+    assert not breaker.allow()
+    assert 29 < breaker.retry_after() <= 30
+
+    with patch("lycophron.breaker.time.time", return_value=breaker._open_until):
+        assert breaker.state == BreakerState.HALF_OPEN
+        # A single probe goes through
+        assert breaker.allow()
+        assert not breaker.allow()
+        assert breaker.record(None)
+    assert breaker.state == BreakerState.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_ignores_client_errors(http_error):
+    """Test that rate limits and invalid requests do not open the breaker."""
+    breaker = CircuitBreaker(window=4, min_calls=4)
+    for _ in range(4):
+        breaker.record(http_error(429))
+        breaker.record(http_error(400))
+    assert breaker.state == BreakerState.CLOSED
+
+
+def test_breaker_failed_probe(http_error):
+    """Test that a failed probe opens the breaker for another cooldown."""
+    breaker = CircuitBreaker(window=2, min_calls=2, cooldown=30)
+    breaker.record(http_error(500))
+    breaker.record(http_error(500))
+    with patch("lycophron.breaker.time.time", return_value=breaker._open_until):
+        assert breaker.allow()
+        assert not breaker.record(http_error(502))
+    assert breaker.state == BreakerState.OPEN
+
+
+def test_breaker_shared_state(http_error):
+    """Test that the state is shared through its file."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        state_path = os.path.join(tmpdir, ".breaker")
+        breaker = CircuitBreaker(window=2, min_calls=2, state_path=state_path)
+        other = CircuitBreaker(state_path=state_path)
+        breaker.record(http_error(503))
+        breaker.record(http_error(503))
+        assert other.state == BreakerState.OPEN
+        assert not other.allow()
@@ -0,0 +1,91 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the JSON codec."""
+
+import json
+from datetime import datetime
+
+import pytest
+
+from lycophron import codec
+from lycophron.client import DraftMetadata
+from lycophron.serializers import JSONSerializer
+from lycophron.template import LazyReference
+
+DATA = {
+    "title": "Nycteris thébaïca",
+    "ref": LazyReference("record1", "doi", False),
+    "created": datetime(2023, 5, 17, 10, 30, 1, 123),
+    "count": 3,
+    "big": 2**70,
+}
+
+EXPECTED = {
+    "title": "Nycteris thébaïca",
+    "ref": {
+        "type": "lazy_reference",
+        "record_id": "record1",
+        "field": "doi",
+        "bidirectional": False,
+    },
+    "created": "2023-05-17T10:30:01.000123",
+    "count": 3,
+    "big": 2**70,
+}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def backend(request, monkeypatch):
+    """Run the test with each codec backend."""
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(codec, "orjson", None)
+    return request.param
+
+
+def test_dumps(backend):
+    """Test encoding of the supported types."""
+    assert json.loads(codec.dumps(DATA)) == EXPECTED
+    assert json.loads(codec.dumps_bytes(DATA)) == EXPECTED
+    assert "thébaïca" in codec.dumps(DATA)
+    assert codec.dumps({"a": [1]}, indent=True) == '{\n  "a": [\n    1\n  ]\n}'
+
+
+def test_loads(backend):
+    """Test decoding strings and bytes."""
+    assert codec.loads(codec.dumps(DATA)) == EXPECTED
+    assert codec.loads(codec.dumps_bytes(DATA)) == EXPECTED
+
+
+def test_backends_match():
+    """Test that both backends produce the same documents."""
+    pytest.importorskip("orjson")
+    fast = codec.dumps({k: v for k, v in DATA.items() if k != "big"})
+    slow = codec._stdlib_dumps({k: v for k, v in DATA.items() if k != "big"})
+    assert json.loads(fast) == json.loads(slow)
+
+
+def test_payloads():
+    """Test the serializers built on the codec."""
+    body = DraftMetadata(metadata={"title": "Nycteris thébaïca"}).to_request()
+    assert isinstance(body, bytes)
+    assert json.loads(body) == {"metadata": {"title": "Nycteris thébaïca"}}
+
+    serialized = JSONSerializer().serialize([{"ref": DATA["ref"]}])
+    assert json.loads(serialized) == [{"ref": EXPECTED["ref"]}]
+
+
+def test_json_export(backend):
+    """Test the format and the unsupported types of JSON exports."""
+    # The same with both backends
+    serialized = JSONSerializer().serialize([{"a": "é"}])
+    assert serialized == '[\n    {\n        "a": "\\u00e9"\n    }\n]'
+
+    with pytest.raises(TypeError):
+        JSONSerializer().serialize([{"a": object()}])
+    # DB columns encode them as strings
+    assert codec.loads(codec.dumps({"a": {1}})) == {"a": "{1}"}
@@ -0,0 +1,121 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the adaptive concurrency limits."""
+
+import threading
+import time
+
+import pytest
+import requests
+from requests.exceptions import HTTPError
+
+from lycophron.concurrency import (
+    AdaptiveChunkSize,
+    AIMDLimiter,
+    ConcurrencyController,
+)
+from lycophron.ratelimit import RateLimiter
+
+
+def _run(limiter, n, error=None):
+    for _ in range(n):
+        try:
+            with limiter.slot():
+                if error:
+                    raise error
+        except HTTPError:
+            pass
+
+
+def test_additive_increase():
+    """Test that the limit grows with successful requests, up to the maximum."""
+    limiter = AIMDLimiter(max_limit=4)
+    _run(limiter, 1)
+    assert limiter.limit == 2
+    _run(limiter, 2)
+    assert limiter.limit == 3
+    _run(limiter, 100)
+    assert limiter.limit == 4
+
+
+@pytest.mark.parametrize("status_code", [429, 503])
+def test_multiplicative_decrease(status_code, http_error):
+    """Test that the limit is halved when Zenodo is overloaded."""
+    limiter = AIMDLimiter(max_limit=16, initial=16)
+    _run(limiter, 1, error=http_error(status_code))
+    assert limiter.limit == 8
+    _run(limiter, 10, error=http_error(status_code))
+    assert limiter.limit == 1
+
+
+def test_client_errors_keep_limit(http_error):
+    """Test that other errors do not change the limit."""
+    limiter = AIMDLimiter(max_limit=16, initial=8)
+    _run(limiter, 1, error=http_error(400))
+    assert limiter.limit == 8 + 1 / 8
+
+
+def test_slow_requests_hold_limit():
+    """Test that the limit does not grow while the latency degrades."""
+    limiter = AIMDLimiter(max_limit=16, initial=4)
+    limiter.latency = 0.001
+    with limiter.slot():
+        time.sleep(0.01)
+    assert limiter.limit == 4
+
+
+def test_in_flight_bounded():
+    """Test that no more requests than the limit run at the same time."""
+    controller = ConcurrencyController({"files": 2})
+    limiter = controller.limiters["files"]
+    peak = []
+
+    def work():
+        with controller.slot("files"):
+            peak.append(limiter.in_flight)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The limit starts at 1 and grows to at most 2
+    assert max(peak) <= 2
+    assert controller.limits() == {"files": 2}
+    with controller.slot("communities"):
+        pass
+
+
+def test_retried_rate_limits_decrease():
+    """Test that 429 responses retried by the session halve the limit."""
+    controller = ConcurrencyController({"metadata": 16})
+    limiter = controller.limiters["metadata"]
+    limiter.limit = 16.0
+    rate_limiter = RateLimiter(6000, on_throttle=controller.throttled)
+    response = requests.Response()
+    response.status_code = 429
+    response.headers["Retry-After"] = "0"
+
+    with controller.slot("metadata"):
+        rate_limiter.update(response)
+    assert limiter.limit == 8
+    # Outside of a slot, nothing to decrease
+    rate_limiter.update(response)
+    with controller.slot("metadata"):
+        pass
+    assert limiter.limit == 8 + 1 / 8
+
+
+def test_chunk_latency_observed_at_once():
+    """Test that observing a chunk weighs as much as each of its records."""
+    chunk, records = AdaptiveChunkSize(), AdaptiveChunkSize()
+    chunk.observe(1.0)
+    records.observe(1.0)
+    chunk.observe(2.0, records=3)
+    for _ in range(3):
+        records.observe(2.0)
+    assert chunk.latency == pytest.approx(records.latency)
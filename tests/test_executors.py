@@ -0,0 +1,170 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the in-process executors."""
+
+import os
+import tempfile
+from contextlib import ExitStack
+from datetime import UTC, datetime, timedelta
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+from sqlalchemy import update
+
+from lycophron.app import SingletonMeta
+from lycophron.cli import lycophron
+from lycophron.executors import EXECUTORS, ThreadExecutor
+from lycophron.models import Record, RecordStatus
+
+
+@pytest.mark.parametrize("executor_cls", EXECUTORS.values())
+def test_executor(executor_cls, fake_client, init_project):
+    """Test publishing all records with each executor."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.TODO] * 10, fake_client)
+
+        assert executor_cls(app.project, concurrency=3, page_size=4).run() == 10
+
+        summary = app.project.status_summary()
+        assert summary["records"][RecordStatus.PUBLISHED.value] == 10
+        assert fake_client.calls.count("create") == 10
+        assert fake_client.calls.count("publish") == 10
+
+
+@pytest.mark.parametrize("executor_cls", EXECUTORS.values())
+def test_executor_creates_drafts_first(executor_cls, fake_client, init_project):
+    """Test that no metadata is sent before all the drafts are created."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.TODO] * 3, fake_client)
+
+        assert executor_cls(app.project, concurrency=1).run() == 3
+
+        assert fake_client.calls == ["create"] * 3 + ["update", "publish"] * 3
+
+
+def test_executor_skips_failed(fake_client, init_project):
+    """Test that failed records are left untouched."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.TODO] * 2, fake_client)
+        record = app.project.db.get_record("record1")
+        record.status = RecordStatus.DRAFT_FAILED
+        app.project.db.session.commit()
+
+        assert ThreadExecutor(app.project).run() == 1
+        assert app.project.db.get_record("record1").status == (
+            RecordStatus.DRAFT_FAILED
+        )
+
+
+def test_executor_matches_celery_path(fake_client, init_project):
+    """Test that executors and the Celery tasks give the same results."""
+    from lycophron.tasks.tasks import STAGE_TASKS, record_dispatcher
+
+    sent = []
+    with ExitStack() as stack:
+        for task in [record_dispatcher, *STAGE_TASKS.values()]:
+            delay = stack.enter_context(patch.object(task, "delay"))
+            delay.side_effect = lambda *args, task=task, **kwargs: sent.append(
+                (task, args, kwargs)
+            )
+        # Run the tasks sent to the queues in order
+        tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.TODO] * 5, fake_client)
+        # Dispatch is then triggered by the records finishing their stages
+        record_dispatcher(10)
+        while sent:
+            task, args, kwargs = sent.pop(0)
+            task(*args, **kwargs)
+        celery_calls = list(fake_client.calls)
+        assert celery_calls[:5] == ["create"] * 5
+        celery_summary = app.project.status_summary()
+        assert celery_summary["records"][RecordStatus.PUBLISHED.value] == 5
+
+    SingletonMeta._instances = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        fake_client.calls.clear()
+        app = init_project([RecordStatus.TODO] * 5, fake_client)
+        ThreadExecutor(app.project).run()
+        # All the drafts are created first, as with Celery
+        assert fake_client.calls[:5] == ["create"] * 5
+        assert sorted(fake_client.calls) == sorted(celery_calls)
+        summary = app.project.status_summary()
+        assert summary["records"] == celery_summary["records"]
+
+
+def test_executor_stop(fake_client, init_project):
+    """Test that a stopped executor finishes the records in progress only."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.TODO] * 10, fake_client)
+        executor = ThreadExecutor(app.project, concurrency=1, page_size=2)
+        process = executor.process
+
+        def process_and_stop(record_id, stages=None):
+            process(record_id, stages)
+            executor.stop()
+
+        executor.process = process_and_stop
+        assert executor.run() <= 2
+
+        # Stopped while creating the drafts, the other stages do not start
+        summary = app.project.status_summary()
+        assert 1 <= summary["records"][RecordStatus.DRAFT_CREATED.value] <= 2
+        assert summary["records"][RecordStatus.QUEUED.value] >= 8
+        assert "update" not in fake_client.calls
+
+
+@pytest.mark.parametrize("engine", EXECUTORS)
+def test_publish_command(engine, fake_client, init_project):
+    """Test the publish command."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        init_project([RecordStatus.TODO] * 3, fake_client)
+
+        result = CliRunner().invoke(
+            lycophron, ["publish", "--engine", engine, "--concurrency", "2"]
+        )
+        assert result.exit_code == 0
+        assert "3 records processed. Published: 3, failed: 0." in result.output
+
+
+def test_executor_resumes_without_broker(fake_client, init_project):
+    """Test that the breaker closing does not send a message to the broker."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.TODO] * 2, fake_client)
+        app.breaker._trip()
+        app.breaker._open_until = 0.0
+
+        with patch("lycophron.tasks.tasks.record_dispatcher.delay") as delay:
+            assert ThreadExecutor(app.project, concurrency=1).run() == 2
+        assert not delay.called
+        assert app.project.status_summary()["records"]["PUBLISHED"] == 2
+
+
+def test_executor_waits_for_deferred_records(fake_client, init_project):
+    """Test that the records deferred to later are processed once due."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.TODO] * 2, fake_client)
+        next_attempt_at = datetime.now(UTC).replace(tzinfo=None) + timedelta(
+            seconds=0.5
+        )
+        app.project.db.session.execute(
+            update(Record)
+            .where(Record.id == "record1")
+            .values(next_attempt_at=next_attempt_at)
+        )
+        app.project.db.session.commit()
+
+        assert ThreadExecutor(app.project).run() == 2
+        assert app.project.status_summary()["records"]["PUBLISHED"] == 2
@@ -0,0 +1,272 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the multipart uploads against a local stand-in of the files API."""
+
+import json
+import os
+import tempfile
+import threading
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from inveniordm_py.client import InvenioAPI
+
+from lycophron.errors import ChecksumMismatch
+from lycophron.models import File, FileStatus, RecordStatus
+
+PREFIX = "/api/records/r1/draft/files"
+
+
+class FilesAPIHandler(BaseHTTPRequestHandler):
+    """Draft files endpoints, including the multipart ones."""
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _path(self):
+        return self.path[len(PREFIX) :].strip("/").split("/")
+
+    def do_GET(self):
+        files = self.server.files
+        key, *_ = self._path()
+        if not key:
+            return self._reply(200, {"entries": list(files.values())})
+        if key not in files:
+            return self._reply(404)
+        self._reply(200, files[key])
+
+    def do_POST(self):
+        files = self.server.files
+        key, *_ = self._path()
+        if not key:
+            for entry in json.loads(self._body()):
+                transfer = entry.get("transfer", {"type": "L"})
+                if transfer["type"] == "M" and not self.server.multipart:
+                    return self._reply(400, {"message": "Unsupported transfer"})
+                links = {}
+                if transfer["type"] == "M":
+                    host = self.server.parts_host or self.headers["Host"]
+                    base = f"http://{host}{PREFIX}/{entry['key']}"
+                    links["parts"] = [
+                        {"part": part, "url": f"{base}/content/{part}"}
+                        for part in range(1, transfer["parts"] + 1)
+                    ]
+                files[entry["key"]] = {
+                    "key": entry["key"],
+                    "status": "pending",
+                    "transfer": transfer,
+                    "links": links,
+                }
+            return self._reply(201, {"entries": list(files.values())})
+        entry = files[key]
+        parts = self.server.parts.get(key, {})
+        content = b"".join(parts[part] for part in sorted(parts))
+        if self.server.corrupt:
+            content = content[:-1]
+        entry["status"] = "completed"
+        if self.server.etag_checksums:
+            # E.g. S3, whose ETag of a multipart upload is not an MD5
+            entry["checksum"] = f"etag:{md5(content).hexdigest()}-{len(parts)}"
+        else:
+            entry["checksum"] = f"md5:{md5(content).hexdigest()}"
+        self.server.contents[key] = content
+        self._reply(200, entry)
+
+    def do_PUT(self):
+        key, _, *part = self._path()
+        body = self._body()
+        part = int(part[0]) if part else 1
+        if (key, part) in self.server.fail_once:
+            self.server.fail_once.remove((key, part))
+            return self._reply(500, {"message": "Internal server error"})
+        self.server.parts.setdefault(key, {})[part] = body
+        self.server.puts.append((key, part))
+        self.server.authorizations.append(self.headers.get("Authorization"))
+        self._reply(200, self.server.files[key])
+
+    def do_DELETE(self):
+        key, *_ = self._path()
+        self.server.files.pop(key, None)
+        self.server.parts.pop(key, None)
+        self._reply(204)
+
+
+@pytest.fixture
+def files_api():
+    """Local stand-in server of the draft files API."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FilesAPIHandler)
+    server.files = {}
+    server.parts = {}
+    server.contents = {}
+    server.puts = []
+    server.fail_once = set()
+    server.multipart = True
+    server.corrupt = False
+    server.etag_checksums = False
+    server.parts_host = None
+    server.authorizations = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _init_upload(init_project, content):
+    """Initialize a project with a record with a single file, to be uploaded."""
+    app = init_project([RecordStatus.METADATA_UPDATED])
+    app.config["MULTIPART_THRESHOLD"] = 1000
+    app.config["MULTIPART_PART_SIZE"] = 1000
+    app.config["UPLOAD_CHUNK_SIZE"] = 256
+    with open("files/data.bin", "wb") as f:
+        f.write(content)
+    record = app.project.db.get_record("record0")
+    record.upload_id = "r1"
+    record.files.append(File(filename="data.bin"))
+    app.project.db.session.commit()
+    return app
+
+
+def test_multipart_upload_resumes(files_api, init_project):
+    """Test that an interrupted multipart upload resumes from its last part."""
+    from lycophron.tasks.tasks import upload_record_files
+
+    content = os.urandom(4500)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = _init_upload(init_project, content)
+        host, port = files_api.server_address
+        client = InvenioAPI(f"http://{host}:{port}/api", "token")
+        draft = client.records("r1").draft
+        files_api.fail_once.add(("data.bin", 4))
+
+        record = app.project.db.get_record("record0")
+        with pytest.raises(Exception, match="500"):
+            upload_record_files(client, record, draft=draft)
+        assert record.status == RecordStatus.FILE_FAILED
+        assert record.files[0].status == FileStatus.FAILED
+        assert record.files[0].uploaded_parts == 3
+
+        record.status = RecordStatus.METADATA_UPDATED
+        app.project.db.session.commit()
+        upload_record_files(client, record, draft=draft)
+
+        assert record.status == RecordStatus.FILE_UPLOADED
+        assert record.files[0].status == FileStatus.UPLOADED
+        assert files_api.puts == [("data.bin", part) for part in range(1, 6)]
+        assert files_api.contents["data.bin"] == content
+        # Computed while uploading, including the parts sent before the failure
+        assert record.files[0].checksum == f"md5:{md5(content).hexdigest()}"
+
+
+def test_multipart_foreign_part_urls(files_api, init_project):
+    """Test that the token is only sent to Zenodo, not to the storage."""
+    from lycophron.tasks.tasks import upload_record_files
+
+    content = os.urandom(2500)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = _init_upload(init_project, content)
+        host, port = files_api.server_address
+        client = InvenioAPI(f"http://{host}:{port}/api", "token")
+        # Another origin for the same server
+        files_api.parts_host = f"localhost:{port}"
+
+        record = app.project.db.get_record("record0")
+        upload_record_files(client, record, draft=client.records("r1").draft)
+
+        assert record.status == RecordStatus.FILE_UPLOADED
+        assert files_api.contents["data.bin"] == content
+        assert files_api.authorizations == [None] * 3
+
+
+def test_multipart_unsupported(files_api, init_project):
+    """Test that files are uploaded at once if parts are not supported."""
+    from lycophron.tasks.tasks import upload_record_files
+
+    content = os.urandom(4500)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = _init_upload(init_project, content)
+        host, port = files_api.server_address
+        client = InvenioAPI(f"http://{host}:{port}/api", "token")
+        files_api.multipart = False
+
+        record = app.project.db.get_record("record0")
+        upload_record_files(client, record, draft=client.records("r1").draft)
+
+        assert record.status == RecordStatus.FILE_UPLOADED
+        assert files_api.puts == [("data.bin", 1)]
+        assert files_api.authorizations == ["Bearer token"]
+        assert files_api.contents["data.bin"] == content
+
+
+@pytest.mark.parametrize("multipart", [True, False])
+def test_upload_checksum_mismatch(files_api, multipart, init_project):
+    """Test that files whose content differs on Zenodo fail."""
+    from lycophron.tasks.tasks import upload_record_files
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = _init_upload(init_project, os.urandom(4500))
+        host, port = files_api.server_address
+        client = InvenioAPI(f"http://{host}:{port}/api", "token")
+        files_api.multipart = multipart
+        files_api.corrupt = True
+
+        record = app.project.db.get_record("record0")
+        with pytest.raises(ChecksumMismatch, match="corrupted"):
+            upload_record_files(client, record, draft=client.records("r1").draft)
+        assert record.files[0].status == FileStatus.FAILED
+        assert record.files[0].checksum is None
+
+
+def test_upload_other_checksum_scheme(files_api, init_project):
+    """Test that remote checksums of another scheme than MD5 are not compared."""
+    from lycophron.tasks.tasks import upload_record_files
+
+    content = os.urandom(4500)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = _init_upload(init_project, content)
+        host, port = files_api.server_address
+        client = InvenioAPI(f"http://{host}:{port}/api", "token")
+        files_api.etag_checksums = True
+
+        record = app.project.db.get_record("record0")
+        upload_record_files(client, record, draft=client.records("r1").draft)
+        assert record.files[0].status == FileStatus.UPLOADED
+        assert record.files[0].checksum == f"md5:{md5(content).hexdigest()}"
+
+
+def test_upload_changed_file(files_api, init_project):
+    """Test that files modified since they were loaded fail."""
+    from lycophron.tasks.tasks import upload_record_files
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = _init_upload(init_project, os.urandom(100))
+        host, port = files_api.server_address
+        client = InvenioAPI(f"http://{host}:{port}/api", "token")
+        record = app.project.db.get_record("record0")
+        record.files[0].checksum = "md5:loaded"
+        app.project.db.session.commit()
+
+        with pytest.raises(ChecksumMismatch, match="changed"):
+            upload_record_files(client, record, draft=client.records("r1").draft)
+        assert record.files[0].status == FileStatus.FAILED
@@ -0,0 +1,194 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test Lycophron project operations."""
+
+import json
+import os
+import sqlite3
+import tempfile
+from unittest.mock import patch
+
+from click.testing import CliRunner
+from sqlalchemy import inspect
+
+from lycophron.app import LycophronApp
+from lycophron.cli import lycophron
+from lycophron.models import FileStatus, RecordStatus
+from lycophron.project import Project
+
+
+def test_status_summary(init_project):
+    """Test the aggregated project status."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project(
+            [
+                RecordStatus.TODO,
+                RecordStatus.DRAFT_CREATED,
+                RecordStatus.PUBLISHED,
+                RecordStatus.FILE_FAILED,
+                RecordStatus.FILE_FAILED,
+            ],
+        )
+
+        summary = app.project.status_summary()
+        assert summary["total"] == 5
+        assert summary["records"]["NEW"] == 1
+        assert summary["records"]["DRAFT_CREATED"] == 1
+        assert summary["records"]["PUBLISHED"] == 1
+        assert summary["records"]["FILE_FAILED"] == 2
+        assert summary["records"]["QUEUED"] == 0
+        assert summary["failures"]["files"] == 2
+        assert summary["failures"]["draft"] == 0
+        assert summary["files"] == {status.value: 0 for status in FileStatus}
+
+        pending = [
+            app.project.db.get_record("record0").updated,
+            app.project.db.get_record("record1").updated,
+        ]
+        assert summary["oldest_pending"] == min(pending)
+
+
+def test_status_summary_empty_project():
+    """Test the project status without records."""
+    runner = CliRunner()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        runner.invoke(lycophron, ["init"])
+
+        summary = LycophronApp().project.status_summary()
+        assert summary["total"] == 0
+        assert summary["oldest_pending"] is None
+        assert not any(summary["failures"].values())
+
+
+def test_status_command(init_project):
+    """Test the status command output."""
+    runner = CliRunner()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        init_project([RecordStatus.TODO, RecordStatus.DRAFT_FAILED])
+
+        result = runner.invoke(lycophron, ["status"])
+        assert result.exit_code == 0
+        assert "Records: 2" in result.output
+        assert "Failures per stage:" in result.output
+
+        result = runner.invoke(lycophron, ["status", "--json"])
+        assert result.exit_code == 0
+        summary = json.loads(result.output)
+        assert summary["total"] == 2
+        assert summary["failures"]["draft"] == 1
+
+
+def test_retry_failed_filters(init_project):
+    """Test resetting failed records with filters."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project(
+            [
+                RecordStatus.FILE_FAILED,
+                RecordStatus.FILE_FAILED,
+                RecordStatus.METADATA_FAILED,
+                RecordStatus.DRAFT_FAILED,
+                RecordStatus.PUBLISHED,
+            ]
+        )
+        db = app.project.db
+        db.get_record("record1").error = "Connection reset by peer"
+        db.get_record("record2").response = {"status": 400, "message": "Invalid"}
+        db.session.commit()
+
+        assert app.project.retry_failed(error="reset") == 1
+        assert db.get_record("record1").status == RecordStatus.TODO
+
+        assert app.project.retry_failed(http_status=400) == 1
+        assert db.get_record("record2").status == RecordStatus.TODO
+
+        assert app.project.retry_failed(statuses=[RecordStatus.FILE_FAILED]) == 1
+        assert db.get_record("record0").status == RecordStatus.TODO
+        assert db.get_record("record3").status == RecordStatus.DRAFT_FAILED
+
+        assert app.project.retry_failed(ids=["record3", "record4"]) == 1
+        assert db.get_record("record3").status == RecordStatus.TODO
+        assert db.get_record("record4").status == RecordStatus.PUBLISHED
+
+
+def test_retry_failed_command(init_project):
+    """Test the retry-failed command with filters."""
+    runner = CliRunner()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        init_project([RecordStatus.FILE_FAILED, RecordStatus.PUBLISH_FAILED])
+
+        result = runner.invoke(lycophron, ["retry-failed", "--status", "file_failed"])
+        assert result.exit_code == 0
+        assert "1 records queued for retrying." in result.output
+
+        result = runner.invoke(lycophron, ["retry-failed"])
+        assert result.exit_code == 0
+        assert "1 records queued for retrying." in result.output
+
+
+def test_retry_failed_notifies_workers(init_project):
+    """Test that retrying records triggers a dispatch while workers run."""
+    runner = CliRunner()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.FILE_FAILED])
+
+        with patch("lycophron.tasks.tasks.record_dispatcher.delay") as delay:
+            runner.invoke(lycophron, ["retry-failed"])
+            assert not delay.called
+
+            with open(app.workers_file, "w") as f:
+                f.write("1")
+            runner.invoke(lycophron, ["retry-failed"])
+            assert delay.called
+
+
+# Schema of the projects created by the first release
+BASELINE_SCHEMA = """
+CREATE TABLE record (
+    id VARCHAR NOT NULL, upload_id VARCHAR, input_metadata JSON,
+    remote_metadata JSON, status VARCHAR(18), response JSON, error VARCHAR,
+    created DATETIME NOT NULL, updated DATETIME NOT NULL, PRIMARY KEY (id)
+);
+CREATE TABLE file (
+    id INTEGER NOT NULL, record_id VARCHAR, filename VARCHAR,
+    status VARCHAR(8), checksum VARCHAR, created DATETIME NOT NULL,
+    updated DATETIME NOT NULL, PRIMARY KEY (id),
+    CONSTRAINT unique_file_per_record UNIQUE (record_id, filename),
+    FOREIGN KEY(record_id) REFERENCES record (id)
+);
+INSERT INTO record (id, status, created, updated)
+    VALUES ('record0', 'DRAFT_CREATED', '2023-01-01', '2023-01-01');
+INSERT INTO file (id, record_id, filename, status, created, updated)
+    VALUES (1, 'record0', 'data.bin', 'TODO', '2023-01-01', '2023-01-01');
+"""
+
+
+def test_upgrade_baseline_db():
+    """Test that the DB of a project from an older version is upgraded."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "lycophron.db")
+        with sqlite3.connect(path) as conn:
+            conn.executescript(BASELINE_SCHEMA)
+        conn.close()
+
+        db = Project(f"sqlite:///{path}").db
+        record = db.get_record("record0")
+        assert record.lease_owner is None
+        assert record.attempt_count == 0
+        assert record.files[0].uploaded_parts == 0
+        assert db.get_dispatchable_records() == [record]
+        assert {"ix_record_status_updated", "ix_file_status"} <= {
+            index["name"]
+            for table in ("record", "file")
+            for index in inspect(db.engine).get_indexes(table)
+        }
+        # Up to date, nothing left to add
+        assert db.upgrade_schema() == []
@@ -0,0 +1,127 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the rate limiting of the requests sent to Zenodo."""
+
+import time
+from email.utils import formatdate
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from lycophron.client import RateLimitedSession
+from lycophron.ratelimit import RateLimiter, parse_reset, parse_retry_after
+
+
+class FakeAdapter(BaseAdapter):
+    """Adapter replying with the given status codes and headers."""
+
+    def __init__(self, replies):
+        super().__init__()
+        self.replies = list(replies)
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(time.monotonic())
+        status_code, headers = self.replies.pop(0)
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers.update(headers)
+        response.request = request
+        response._content = b"{}"
+        return response
+
+    def close(self):
+        pass
+
+
+def _session(limiter, replies):
+    session = RateLimitedSession(limiter)
+    adapter = FakeAdapter(replies)
+    session.mount("http://", adapter)
+    return session, adapter
+
+
+def test_parse_headers():
+    """Test parsing the rate limit headers."""
+    now = time.time()
+    assert parse_retry_after("2") == 2
+    assert parse_retry_after("-2") == 0
+    assert 9 <= parse_retry_after(formatdate(now + 10, usegmt=True), now) <= 10
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
+    assert parse_reset(str(int(now) + 30), now) == int(now) + 30 - now
+    assert parse_reset("30") == 30
+    assert parse_reset(None) is None
+
+
+def test_token_bucket_paces_requests():
+    """Test that requests beyond the burst are paced at the rate."""
+    limiter = RateLimiter(rate=60 * 20, burst=2)
+    start = time.monotonic()
+    for _ in range(4):
+        limiter.acquire()
+    # Two requests from the burst, then two more at 20 per second
+    assert time.monotonic() - start >= 0.09
+
+
+def test_token_bucket_is_shared(tmp_path):
+    """Test that the processes of a project share the same budget."""
+    pytest.importorskip("fcntl")
+    state_path = tmp_path / ".ratelimit"
+    limiter = RateLimiter(rate=60 * 20, burst=2, state_path=state_path)
+    other = RateLimiter(rate=60 * 20, burst=2, state_path=state_path)
+    start = time.monotonic()
+    limiter.acquire()
+    limiter.acquire()
+    # The burst is spent, whichever process sends the next requests
+    other.acquire()
+    other.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_rate_follows_headers():
+    """Test that the budget left lowers the pace."""
+    limiter = RateLimiter(rate=100)
+    response = requests.Response()
+    response.status_code = 200
+    response.headers.update({"X-RateLimit-Remaining": "10", "X-RateLimit-Reset": "20"})
+    limiter.update(response)
+    assert limiter.rate == 0.5
+
+    response.headers["X-RateLimit-Remaining"] = "0"
+    limiter.update(response)
+    assert 19 < limiter.blocked_for() <= 20
+
+
+def test_retry_after_is_shared(tmp_path):
+    """Test that a 429 blocks the limiters of other processes too."""
+    state_path = tmp_path / ".ratelimit"
+    limiter = RateLimiter(rate=600, state_path=state_path)
+    other = RateLimiter(rate=600, state_path=state_path)
+    session, adapter = _session(limiter, [(429, {"Retry-After": "0.2"}), (200, {})])
+
+    start = time.monotonic()
+    response = session.get("http://zenodo.test/api/records")
+    assert response.status_code == 200
+    assert len(adapter.sent) == 2
+    assert adapter.sent[1] - start >= 0.2
+    # The block was written for the other processes of the project
+    assert other.blocked_for() <= 0
+    assert other._blocked_until == limiter._blocked_until
+
+    limiter.block(5)
+    assert 4 < other.blocked_for() <= 5
+
+
+def test_streamed_body_not_retried():
+    """Test that streamed uploads are not sent twice."""
+    limiter = RateLimiter(rate=600)
+    session, adapter = _session(limiter, [(429, {"Retry-After": "0"})])
+
+    response = session.put("http://zenodo.test/content", data=iter([b"data"]))
+    assert response.status_code == 429
+    assert len(adapter.sent) == 1
@@ -390,25 +390,26 @@ def test_two_phase_processing(mock_publish, mock_upload, mock_update, mock_creat
             app.project.db.session.commit()
 
         # Run the dispatcher (Phase 1)
-        with patch("lycophron.tasks.tasks.process_record.delay") as mock_delay:
+        with patch("lycophron.tasks.tasks.create_drafts.delay") as mock_delay:
             record_dispatcher(10)
 
             # Check that records were queued
-            assert mock_delay.call_count == 2
+            assert len(mock_delay.call_args.args[0]) == 2
 
             # Update records to DRAFT_CREATED to simulate completion of Phase 1
             for record_id in ["article1", "dataset1"]:
                 record = app.project.db.get_record(record_id)
                 record.status = RecordStatus.DRAFT_CREATED
                 record.upload_id = f"draft_{record_id}"
+                record.lease_owner = record.lease_expires_at = None
                 app.project.db.session.commit()
 
         # Run the dispatcher again (Phase 2)
-        with patch("lycophron.tasks.tasks.process_record.delay") as mock_delay:
+        with patch("lycophron.tasks.tasks.update_metadata.delay") as mock_delay:
             record_dispatcher(10)
 
             # Check that records were processed again
-            assert mock_delay.call_count == 2
+            assert len(mock_delay.call_args.args[0]) == 2
 
             # Setup mock client for process_record
             app.client = MagicMock()
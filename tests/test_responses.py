@@ -0,0 +1,117 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test storage of Zenodo responses."""
+
+import os
+import sqlite3
+import tempfile
+
+from click.testing import CliRunner
+from inveniordm_py.records.metadata import DraftMetadata
+
+from lycophron.app import LycophronApp
+from lycophron.cli import lycophron
+from lycophron.models import RecordStatus
+from lycophron.responses import ResponseRetention, compact_response, retain_response
+
+DRAFT = {
+    "id": "12345",
+    "status": "draft",
+    "pids": {"doi": {"identifier": "10.5281/zenodo.12345", "provider": "datacite"}},
+    "links": {"self": "https://zenodo.org/api/records/12345/draft"},
+    "metadata": {"title": "A title", "description": "x" * 10000},
+    "files": {"enabled": True},
+}
+
+
+def test_compact_response():
+    """Test the projection of a response."""
+    compact = compact_response(DraftMetadata(**DRAFT))
+    assert compact == {
+        "id": "12345",
+        "status": "draft",
+        "links": DRAFT["links"],
+        "doi": "10.5281/zenodo.12345",
+    }
+
+
+def test_compact_response_idempotent():
+    """Test that compacting a response again keeps it, DOI included."""
+    compact = retain_response(DRAFT)
+    assert retain_response(compact) == compact
+    assert compact["doi"] == "10.5281/zenodo.12345"
+
+
+def test_retain_response():
+    """Test the retention policy."""
+    assert retain_response(DRAFT, failed=True) == DRAFT
+    assert retain_response(DRAFT, policy=ResponseRetention.FULL) == DRAFT
+    assert retain_response(DRAFT, policy="full") == DRAFT
+    assert "metadata" not in retain_response(DRAFT)
+    assert retain_response("not a dict") == "not a dict"
+
+
+def test_large_responses_are_compressed():
+    """Test that large responses are compressed transparently."""
+    runner = CliRunner()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        runner.invoke(lycophron, ["init"])
+        db = LycophronApp().project.db
+
+        db.add_record({"id": "record1", "input_metadata": {}})
+        record = db.get_record("record1")
+        record.status = RecordStatus.METADATA_FAILED
+        record.response = {**DRAFT, "status": 400, "message": "Invalid"}
+        db.session.commit()
+        db.session.expire_all()
+
+        assert db.get_record("record1").response["metadata"] == DRAFT["metadata"]
+
+        conn = sqlite3.connect(os.path.join(tmpdir, "lycophron.db"))
+        (raw,) = conn.execute("SELECT response FROM record").fetchone()
+        conn.close()
+        assert '"$zlib"' in raw
+        assert len(raw) < 2000
+
+        # The status stays queryable
+        assert db.reset_failed_records(http_status=400) == 1
+
+
+def test_compact_command():
+    """Test compacting the responses of an existing project."""
+    runner = CliRunner()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        runner.invoke(lycophron, ["init"])
+        db = LycophronApp().project.db
+
+        for record_id, status in [
+            ("record1", RecordStatus.PUBLISHED),
+            ("record2", RecordStatus.PUBLISH_FAILED),
+        ]:
+            db.add_record({"id": record_id, "input_metadata": {}})
+            record = db.get_record(record_id)
+            record.status = status
+            record.response = DRAFT
+            db.session.commit()
+        updated = db.get_record("record1").updated
+
+        result = runner.invoke(lycophron, ["compact", "--yes"])
+        assert result.exit_code == 0
+        assert "2 responses compacted." in result.output
+
+        db.session.expire_all()
+        published = db.get_record("record1")
+        assert published.response["doi"] == "10.5281/zenodo.12345"
+        assert "metadata" not in published.response
+        assert published.updated == updated
+        assert db.get_record("record2").response == DRAFT
+
+        # Compacting again keeps the DOI
+        assert runner.invoke(lycophron, ["compact", "--yes"]).exit_code == 0
+        db.session.expire_all()
+        assert db.get_record("record1").response["doi"] == "10.5281/zenodo.12345"
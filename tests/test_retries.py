@@ -0,0 +1,38 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the classification of errors and the retry backoff."""
+
+import pytest
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+from lycophron.retries import backoff, is_transient
+
+
+@pytest.mark.parametrize("status_code", [408, 429, 500, 502, 503, 504])
+def test_transient_http_errors(status_code, http_error):
+    """Test that rate limits and server errors are transient."""
+    assert is_transient(http_error(status_code))
+
+
+@pytest.mark.parametrize("status_code", [400, 403, 404, 409])
+def test_permanent_http_errors(status_code, http_error):
+    """Test that client errors, e.g. invalid metadata, are permanent."""
+    assert not is_transient(http_error(status_code))
+
+
+def test_other_errors():
+    """Test that network errors are transient, other errors permanent."""
+    assert is_transient(ConnectionError("Connection reset by peer"))
+    assert is_transient(Timeout())
+    assert not is_transient(HTTPError())
+    assert not is_transient(ValueError("Invalid metadata"))
+
+
+def test_backoff():
+    """Test that the backoff grows exponentially, with jitter, up to a cap."""
+    delays = [backoff(attempt, base=1, cap=10) for attempt in range(10)]
+    assert all(0 <= delay <= min(10, 2**i) for i, delay in enumerate(delays))
+    assert len({backoff(5, base=1) for _ in range(10)}) > 1
@@ -0,0 +1,37 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the state files shared by the processes of a project."""
+
+import json
+
+from lycophron.state import StateFile
+
+
+def test_state_file_read_once(tmp_path):
+    """Test that a state is read only when the file changed."""
+    path = tmp_path / ".state"
+    state = StateFile(path)
+    other = StateFile(path)
+    assert other.read() is None
+
+    state.write(1.5)
+    # Its own write is already known
+    assert state.read() is None
+    assert other.read() == 1.5
+    assert other.read() is None
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_state_file_invalid(tmp_path):
+    """Test that a missing or invalid state is ignored."""
+    path = tmp_path / ".state"
+    assert StateFile(None).read() is None
+    StateFile(None).write(1.0)
+    path.write_text("{")
+    assert StateFile(path, loads=json.loads).read() is None
+
+    StateFile(path, dumps=json.dumps).write({"open": True})
+    assert StateFile(path, loads=json.loads).read() == {"open": True}
@@ -0,0 +1,102 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the streaming of the files to upload."""
+
+import os
+from hashlib import md5
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from lycophron.streams import FileStream, prefetch
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(os.urandom(10_000))
+    return path
+
+
+def test_stream_chunks(data_file):
+    """Test that a file is read in chunks, then closed."""
+    with FileStream(data_file, chunk_size=4096) as stream:
+        assert len(stream) == 10_000
+        chunks = [bytes(chunk) for chunk in stream]
+        assert [len(chunk) for chunk in chunks] == [4096, 4096, 1808]
+        assert len(stream) == 0
+    assert stream.closed
+    assert b"".join(chunks) == data_file.read_bytes()
+
+
+def test_stream_window(data_file):
+    """Test that a part of a file is read, up to the end of the file."""
+    content = data_file.read_bytes()
+    with FileStream(data_file, offset=3000, length=5000, chunk_size=4096) as stream:
+        assert len(stream) == 5000
+        assert b"".join(bytes(chunk) for chunk in stream) == content[3000:8000]
+    with FileStream(data_file, offset=8000, length=5000) as stream:
+        assert bytes(stream.read()) == content[8000:]
+
+
+def test_stream_empty_file(tmp_path):
+    """Test that empty files can be streamed."""
+    path = tmp_path / "empty.bin"
+    path.touch()
+    with FileStream(path) as stream:
+        assert len(stream) == 0
+        assert stream.read() == b""
+
+
+def test_stream_request_body(data_file):
+    """Test that requests sends streams with their length."""
+    with FileStream(data_file, offset=1000) as stream:
+        request = requests.Request("PUT", "http://localhost/", data=stream)
+        prepared = request.prepare()
+        assert prepared.headers["Content-Length"] == "9000"
+        assert prepared.body is stream
+
+
+def test_stream_digest(data_file):
+    """Test that the checksum is computed while the stream is read."""
+    digest = md5()
+    with FileStream(data_file, chunk_size=4096, digest=digest) as stream:
+        for _ in stream:
+            pass
+    assert digest.hexdigest() == md5(data_file.read_bytes()).hexdigest()
+
+
+def test_stream_read_ahead(data_file):
+    """Test that the next chunks are read ahead, up to the end of the file."""
+    with FileStream(data_file, length=5000, chunk_size=2048, read_ahead=2) as stream:
+        stream.read()
+        assert stream._read_ahead_end == 2048 * 3
+        stream.read()
+        assert stream._read_ahead_end == 2048 * 4
+        # Past the end of the window, into the rest of the file
+        stream.read()
+        assert stream._read_ahead_end == 5000 + 2048 * 2
+
+
+def test_prefetch(data_file):
+    """Test that the start of a file is read ahead."""
+    with patch("lycophron.streams.os.posix_fadvise") as fadvise:
+        prefetch(data_file, 4096)
+        prefetch(data_file.parent / "missing.bin", 4096)
+    assert fadvise.call_count == 1
+    assert fadvise.call_args.args[1:] == (0, 4096, os.POSIX_FADV_WILLNEED)
+
+
+def test_stream_throttles(data_file):
+    """Test that each chunk waits for the bandwidth limiters."""
+    throttles = (MagicMock(), MagicMock())
+    with FileStream(data_file, chunk_size=4096, throttles=throttles) as stream:
+        for _ in stream:
+            pass
+    for throttle in throttles:
+        sizes = [call.args[0] for call in throttle.consume.call_args_list]
+        assert sizes == [4096, 4096, 1808]
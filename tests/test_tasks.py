@@ -0,0 +1,556 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the publishing tasks."""
+
+import os
+import tempfile
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+from sqlalchemy import update
+
+from lycophron.concurrency import AdaptiveChunkSize
+from lycophron.models import File, FileStatus, Record, RecordStatus
+
+
+@patch("lycophron.tasks.tasks.publish_record")
+@patch("lycophron.tasks.tasks.upload_record_files")
+@patch("lycophron.tasks.tasks.update_draft_metadata")
+def test_tasks_remove_their_session(
+    mock_update, mock_upload, mock_publish, init_project
+):
+    """Test that tasks do not keep records in the thread-local session."""
+    from lycophron.tasks.tasks import process_record, record_dispatcher
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.DRAFT_CREATED])
+        db = app.project.db
+
+        process_record("record0")
+        assert mock_update.called
+        assert not db.session.registry.has()
+
+        with patch("lycophron.tasks.tasks.update_metadata.delay"):
+            record_dispatcher(10)
+        assert not db.session.registry.has()
+
+
+def test_task_scope_rolls_back_on_error(init_project):
+    """Test that a failing task leaves no pending changes behind."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        db = init_project([RecordStatus.TODO]).project.db
+
+        with pytest.raises(RuntimeError), db.task_scope() as session:
+            session.get(Record, "record0").error = "Not committed"
+            raise RuntimeError("Task failed")
+
+        assert db.get_record("record0").error is None
+
+
+def _dispatched(delay):
+    """Return the record IDs sent in the mocked chunked tasks."""
+    return [record_id for call in delay.call_args_list for record_id in call.args[0]]
+
+
+@patch("lycophron.tasks.tasks.publish_record")
+@patch("lycophron.tasks.tasks.upload_record_files")
+@patch("lycophron.tasks.tasks.update_draft_metadata")
+def test_dispatcher_leases_records(
+    mock_update, mock_upload, mock_publish, init_project
+):
+    """Test that records are not enqueued again while their task runs."""
+    from lycophron.tasks.tasks import publish_records, record_dispatcher
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.DRAFT_CREATED] * 2)
+        db = app.project.db
+
+        with patch("lycophron.tasks.tasks.update_metadata.delay") as delay:
+            record_dispatcher(10)
+            record_dispatcher(10)
+        assert _dispatched(delay) == ["record0", "record1"]
+
+        # Once through its last stage, the lease is released
+        publish_records(["record1"], **delay.call_args.kwargs)
+        record = db.get_record("record1")
+        assert record.lease_owner is None
+        assert record.lease_expires_at is None
+        with patch("lycophron.tasks.tasks.update_metadata.delay") as delay:
+            record_dispatcher(10)
+        assert _dispatched(delay) == ["record1"]
+
+        # Leases of crashed workers are taken over once expired
+        record = db.get_record("record0")
+        record.lease_expires_at = datetime.now(UTC).replace(tzinfo=None) - timedelta(
+            seconds=1
+        )
+        db.session.commit()
+        with patch("lycophron.tasks.tasks.update_metadata.delay") as delay:
+            record_dispatcher(10)
+        assert _dispatched(delay) == ["record0"]
+
+
+def test_dispatcher_sends_chunks(init_project):
+    """Test that records are sent in chunks to the queue of their stage."""
+    from lycophron.tasks.tasks import record_dispatcher
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.DRAFT_CREATED] * 25)
+        app.config["CONCURRENCY_LIMITS"] = {"metadata": 1}
+
+        with patch("lycophron.tasks.tasks.update_metadata.delay") as delay:
+            record_dispatcher(100)
+        assert [len(call.args[0]) for call in delay.call_args_list] == [10, 10, 5]
+
+        # Fast records, timed by the stage workers in other processes, make
+        # larger chunks
+        AdaptiveChunkSize(state_path=app.chunk_size.state_path).observe(0.5)
+        assert app.chunk_size.size == 60
+
+
+def test_dispatcher_spreads_small_batches(init_project):
+    """Test that small batches are spread over the threads of the stage."""
+    from lycophron.tasks.tasks import record_dispatcher
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.DRAFT_CREATED] * 10)
+        app.config["CONCURRENCY_LIMITS"] = {"metadata": 4}
+
+        with patch("lycophron.tasks.tasks.update_metadata.delay") as delay:
+            record_dispatcher(100)
+        assert [len(call.args[0]) for call in delay.call_args_list] == [3, 3, 3, 1]
+
+
+def test_dispatcher_skips_stale_records(init_project):
+    """Test that stale records neither take the batch nor re-trigger it."""
+    from lycophron.tasks.tasks import record_dispatcher
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.DRAFT_CREATED] * 4)
+        db = app.project.db
+        # Bulk update, `updated` is otherwise set on every change
+        db.session.execute(
+            update(Record)
+            .where(Record.id != "record3")
+            .values(updated=datetime.now(UTC).replace(tzinfo=None) - timedelta(days=2))
+        )
+        db.session.commit()
+
+        with (
+            patch("lycophron.tasks.tasks.update_metadata.delay") as delay,
+            patch("lycophron.tasks.tasks.record_dispatcher.delay") as redispatch,
+        ):
+            record_dispatcher(3)
+        assert _dispatched(delay) == ["record3"]
+        assert not redispatch.called
+
+
+def test_dispatcher_waits_for_pending_drafts(init_project):
+    """Test that no metadata is sent while drafts are still pending."""
+    from lycophron.tasks.tasks import STAGE_TASKS, record_dispatcher
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.TODO, RecordStatus.DRAFT_CREATED])
+        db = app.project.db
+
+        with (
+            patch.object(STAGE_TASKS["draft"], "delay") as create,
+            patch.object(STAGE_TASKS["metadata"], "delay") as update,
+        ):
+            record_dispatcher(10)
+            # The draft of record0 is still queued
+            record_dispatcher(10)
+        assert _dispatched(create) == ["record0"]
+        assert not update.called
+
+        record = db.get_record("record0")
+        record.status = RecordStatus.DRAFT_CREATED
+        record.upload_id = "draft0"
+        db.session.commit()
+        db.release_lease("record0", create.call_args.kwargs["lease"])
+        with patch.object(STAGE_TASKS["metadata"], "delay") as update:
+            record_dispatcher(10)
+        assert _dispatched(update) == ["record0", "record1"]
+
+
+@patch("lycophron.tasks.tasks.request_dispatch")
+@patch("lycophron.tasks.tasks.run_stage")
+def test_stage_chains_to_next(mock_run_stage, mock_request_dispatch, init_project):
+    """Test that records going through a stage are sent to the next one."""
+    from lycophron.tasks.tasks import create_drafts, update_metadata
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        db = init_project([RecordStatus.DRAFT_CREATED] * 3).project.db
+        db.lease_records(["record0", "record1", "record2"], "lease", ttl=60)
+
+        # Each record is isolated from the failures of the others
+        mock_run_stage.side_effect = [RuntimeError("Failed"), True, False]
+        with patch("lycophron.tasks.tasks.upload_files.delay") as delay:
+            update_metadata(["record0", "record1", "record2"], lease="lease")
+        delay.assert_called_once_with(["record1"], lease="lease")
+        # Records leaving the pipeline trigger a dispatch
+        assert mock_request_dispatch.call_count == 1
+        assert [db.get_record(f"record{i}").lease_owner for i in range(3)] == [
+            None,
+            "lease",
+            None,
+        ]
+
+        # Draft creation does not chain, so that all records get a DOI first
+        mock_run_stage.side_effect = None
+        mock_run_stage.return_value = True
+        with patch("lycophron.tasks.tasks.update_metadata.delay") as delay:
+            create_drafts(["record1"], lease="lease")
+        assert not delay.called
+        assert db.get_record("record1").lease_owner is None
+        assert mock_request_dispatch.call_count == 2
+
+
+@patch("lycophron.tasks.tasks.request_dispatch")
+@patch("lycophron.tasks.tasks.run_stage", return_value=True)
+def test_stage_renews_leases(mock_run_stage, mock_request_dispatch, init_project):
+    """Test that leases are extended at each stage, unless taken over."""
+    from lycophron.tasks.tasks import update_metadata
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        db = init_project([RecordStatus.DRAFT_CREATED] * 2).project.db
+        # Expired while queued, then taken over by another dispatch for record1
+        db.lease_records(["record0", "record1"], "lease", ttl=-1)
+        db.lease_records(["record1"], "other", ttl=60)
+
+        with patch("lycophron.tasks.tasks.upload_files.delay") as delay:
+            update_metadata(["record0", "record1"], lease="lease")
+        delay.assert_called_once_with(["record0"], lease="lease")
+        assert mock_run_stage.call_count == 1
+        record = db.get_record("record0")
+        assert record.lease_expires_at > datetime.now(UTC).replace(tzinfo=None)
+        assert db.get_record("record1").lease_owner == "other"
+
+
+@patch("lycophron.tasks.tasks.request_dispatch")
+@patch("lycophron.tasks.tasks.run_stage")
+def test_stage_keeps_lease(mock_run_stage, mock_request_dispatch, init_project):
+    """Test that the lease is renewed while a stage runs for longer than it."""
+    from lycophron.tasks.tasks import upload_files
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.METADATA_UPDATED])
+        app.config["LEASE_TTL"] = 0.3
+        db = app.project.db
+        db.lease_records(["record0"], "lease", ttl=0.3)
+        taken_over = []
+
+        def upload(record, stage):
+            time.sleep(0.6)
+            # E.g. another dispatcher
+            taken_over.extend(db.lease_records(["record0"], "other", ttl=60))
+            return True
+
+        mock_run_stage.side_effect = upload
+        with patch("lycophron.tasks.tasks.publish_records.delay") as delay:
+            upload_files(["record0"], lease="lease")
+        assert taken_over == []
+        delay.assert_called_once_with(["record0"], lease="lease")
+
+
+@patch("lycophron.tasks.tasks.request_dispatch")
+@patch("lycophron.tasks.tasks.run_stage", return_value=True)
+def test_stage_observes_chunk_latency(
+    mock_run_stage, mock_request_dispatch, init_project
+):
+    """Test that the latency of a chunk is written once, not per record."""
+    from lycophron.tasks.tasks import update_metadata
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.DRAFT_CREATED] * 3)
+
+        with (
+            patch("lycophron.tasks.tasks.upload_files.delay"),
+            patch.object(app.chunk_size._state, "write") as write_state,
+        ):
+            update_metadata(["record0", "record1", "record2"])
+        write_state.assert_called_once()
+        assert app.chunk_size.latency is not None
+
+
+def test_lease_records(init_project):
+    """Test that a record is leased to a single owner."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        db = init_project([RecordStatus.TODO] * 3).project.db
+
+        assert db.lease_records(["record0", "record1"], "a", ttl=60) == [
+            "record0",
+            "record1",
+        ]
+        assert db.lease_records(["record0", "record1", "record2"], "b", 60) == [
+            "record2"
+        ]
+        assert not db.release_lease("record0", "b")
+        assert db.release_lease("record0", "a")
+        assert db.lease_records(["record0"], "b", ttl=60) == ["record0"]
+
+
+def test_run_stage_schedules_transient_errors(http_error, init_project):
+    """Test that transient errors schedule another attempt of the stage."""
+    from lycophron.tasks.tasks import record_dispatcher, run_stage
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.QUEUED])
+        db = app.project.db
+        record = db.get_record("record0")
+        record.upload_id = None
+        app.client.records.create.side_effect = [
+            http_error(429, **{"Retry-After": "120"}),
+            http_error(502),
+            MagicMock(data={"id": "draft0"}),
+        ]
+
+        assert not run_stage(record, "draft")
+        assert record.status == RecordStatus.QUEUED
+        assert record.attempt_count == 1
+        wait = record.next_attempt_at - datetime.now(UTC).replace(tzinfo=None)
+        assert timedelta(seconds=110) < wait <= timedelta(seconds=120)
+
+        # Not dispatched before its time
+        with patch("lycophron.tasks.tasks.create_drafts.delay") as delay:
+            record_dispatcher(10)
+        assert not delay.called
+
+        record = db.get_record("record0")
+        assert not run_stage(record, "draft")
+        assert record.attempt_count == 2
+        assert record.response["status"] == 502
+
+        assert run_stage(record, "draft")
+        assert record.status == RecordStatus.DRAFT_CREATED
+        assert record.attempt_count == 0
+        assert record.next_attempt_at is None
+
+
+def test_run_stage_fails_permanent_errors(http_error, init_project):
+    """Test that permanent errors, or too many attempts, fail the record."""
+    from lycophron.tasks.tasks import run_stage
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.QUEUED, RecordStatus.QUEUED])
+        db = app.project.db
+        app.client.records.create.side_effect = http_error(400)
+        record = db.get_record("record0")
+        record.upload_id = None
+        assert not run_stage(record, "draft")
+        assert record.status == RecordStatus.DRAFT_FAILED
+        assert record.next_attempt_at is None
+
+        app.client.records.create.side_effect = http_error(503)
+        record = db.get_record("record1")
+        record.upload_id = None
+        record.attempt_count = app.config["RETRY_MAX_ATTEMPTS"]
+        assert not run_stage(record, "draft")
+        assert record.status == RecordStatus.DRAFT_FAILED
+
+
+def test_run_stage_open_breaker(init_project):
+    """Test that an open breaker reschedules records without calling Zenodo."""
+    from lycophron.tasks.tasks import record_dispatcher, run_stage
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.QUEUED])
+        app.breaker._trip()
+        record = app.project.db.get_record("record0")
+        record.upload_id = None
+
+        assert not run_stage(record, "draft")
+        assert not app.client.records.create.called
+        assert record.status == RecordStatus.QUEUED
+        assert record.attempt_count == 0
+        assert record.next_attempt_at is not None
+
+        record.next_attempt_at = None
+        app.project.db.session.commit()
+        with patch("lycophron.tasks.tasks.create_drafts.delay") as delay:
+            record_dispatcher(10)
+        assert not delay.called
+
+
+def _record_with_files(app, filenames):
+    record = app.project.db.get_record("record0")
+    for filename in filenames:
+        record.files.append(File(filename=filename))
+    app.project.db.session.commit()
+    return record
+
+
+@patch("lycophron.tasks.tasks._send_file", return_value=None)
+def test_upload_record_files_lists_once(mock_send_file, init_project):
+    """Test that the remote files are synced with a single listing request."""
+    from lycophron.tasks.tasks import upload_record_files
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.METADATA_UPDATED])
+        record = _record_with_files(app, ["done.txt", "pending.txt", "missing.txt"])
+        draft = MagicMock()
+        draft.files.get.return_value.data = {
+            "entries": [
+                {"key": "done.txt", "status": "completed"},
+                {"key": "pending.txt", "status": "pending"},
+            ]
+        }
+
+        upload_record_files(app.client, record, draft=draft)
+
+        assert draft.files.get.call_count == 1
+        assert not draft.files.return_value.get.called
+        draft.files.assert_called_once_with("pending.txt")
+        uploaded = [call.args[1] for call in mock_send_file.call_args_list]
+        assert sorted(uploaded) == ["missing.txt", "pending.txt"]
+        assert record.status == RecordStatus.FILE_UPLOADED
+        assert {f.status for f in record.files} == {FileStatus.UPLOADED}
+
+
+@patch("lycophron.tasks.tasks._send_file", return_value=None)
+def test_upload_record_files_skips_same_content(mock_send_file, init_project):
+    """Test that only missing or changed content is uploaded."""
+    from lycophron.tasks.tasks import upload_record_files
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.METADATA_UPDATED])
+        record = _record_with_files(app, ["same.txt", "changed.txt", "uncommitted.txt"])
+        for f in record.files:
+            f.checksum = f"md5:{f.filename}"
+        draft = MagicMock()
+        draft.files.get.return_value.data = {
+            "entries": [
+                {"key": "same.txt", "status": "completed", "checksum": "md5:same.txt"},
+                {"key": "changed.txt", "status": "completed", "checksum": "md5:old"},
+                {
+                    "key": "uncommitted.txt",
+                    "status": "pending",
+                    "checksum": "md5:uncommitted.txt",
+                },
+            ]
+        }
+
+        upload_record_files(app.client, record, draft=draft)
+
+        uploaded = [call.args[1] for call in mock_send_file.call_args_list]
+        assert uploaded == ["changed.txt"]
+        assert draft.files.return_value.commit.call_count == 1
+        assert draft.files.return_value.delete.call_count == 1
+        assert {f.status for f in record.files} == {FileStatus.UPLOADED}
+
+
+def test_upload_record_files_concurrently(init_project):
+    """Test that files are sent in parallel, within the per-record limit."""
+    from lycophron.tasks.tasks import upload_record_files
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.METADATA_UPDATED])
+        app.config["FILE_UPLOAD_CONCURRENCY"] = 3
+        filenames = [f"file{i}.txt" for i in range(6)]
+        record = _record_with_files(app, filenames)
+        draft = MagicMock()
+        draft.files.get.return_value.data = {"entries": []}
+        lock = threading.Lock()
+        running = []
+        in_flight = 0
+
+        def send_file(draft, filename, **kwargs):
+            nonlocal in_flight
+            with lock:
+                in_flight += 1
+                running.append(in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight -= 1
+            if filename == "file3.txt":
+                raise requests.HTTPError("Upload failed")
+
+        with (
+            patch("lycophron.tasks.tasks._send_file", side_effect=send_file),
+            pytest.raises(requests.HTTPError),
+        ):
+            upload_record_files(app.client, record, draft=draft)
+
+        assert 1 < max(running) <= 3
+        # The other files are uploaded, but not the record
+        statuses = {f.filename: f.status for f in record.files}
+        assert statuses.pop("file3.txt") == FileStatus.FAILED
+        assert set(statuses.values()) == {FileStatus.UPLOADED}
+        assert record.status == RecordStatus.FILE_FAILED
+
+
+@patch("lycophron.tasks.tasks.prefetch")
+@patch("lycophron.tasks.tasks.run_stage", return_value=False)
+def test_files_stage_prefetches_next_record(
+    mock_run_stage, mock_prefetch, init_project
+):
+    """Test that the files of the next record are read ahead."""
+    from lycophron.tasks.tasks import process_stage
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.METADATA_UPDATED] * 2)
+        record = app.project.db.get_record("record1")
+        record.files.append(File(filename="next.txt"))
+        app.project.db.session.commit()
+
+        with patch("lycophron.tasks.tasks.request_dispatch"):
+            process_stage("files", ["record0", "record1"])
+
+        mock_prefetch.assert_called_once()
+        assert mock_prefetch.call_args.args[0] == "files/next.txt"
+
+
+def test_files_stage_restricted_hours(init_project):
+    """Test that uploads wait for the end of the restricted hours."""
+    from lycophron.tasks.tasks import STAGE_TASKS, record_dispatcher, run_stage
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        app = init_project([RecordStatus.METADATA_UPDATED])
+        # Picked up from the config file without restarting
+        with open("lycophron.cfg", "a") as f:
+            f.write("UPLOAD_RESTRICTED_HOURS = ['00:00-24:00']\n")
+        os.utime("lycophron.cfg", ns=(0, 0))
+        record = app.project.db.get_record("record0")
+        draft = app.client.records.return_value.draft
+        draft.update.return_value.data = {}
+
+        assert not run_stage(record, "files")
+        assert not draft.files.called
+        assert record.status == RecordStatus.METADATA_UPDATED
+        assert record.next_attempt_at > datetime.now(UTC).replace(tzinfo=None)
+        # Drafts and metadata keep going
+        assert run_stage(record, "metadata")
+
+        # Sent to the files stage once the window is over
+        record.next_attempt_at = None
+        app.project.db.session.commit()
+        with patch.object(STAGE_TASKS["files"], "delay") as delay:
+            record_dispatcher(10)
+        assert delay.call_args.args[0] == ["record0"]
@@ -0,0 +1,231 @@
+#
+# Copyright (C) 2023 CERN.
+#
+# Lycophron is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+"""Test the HTTP transport of the InvenioRDM client."""
+
+import asyncio
+import functools
+import io
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import pytest
+import requests
+from click.testing import CliRunner
+
+from lycophron.app import LycophronApp
+from lycophron.cli import lycophron
+from lycophron.client import RateLimitedSession, mount_transport, ssl_verify
+from lycophron.errors import InvalidConfig
+from lycophron.ratelimit import RateLimiter
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Fails the first request of each path with a 503, sleeps on /slow."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append((self.command, self.path))
+        if self.path == "/slow":
+            time.sleep(0.5)
+        failed = (self.command, self.path) in self.server.failed
+        status = 200 if failed else 503
+        self.server.failed.add((self.command, self.path))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = do_POST = _handle
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    server.requests = []
+    server.failed = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", server
+    server.shutdown()
+    server.server_close()
+
+
+def test_ssl_verify():
+    """Test that certificates are verified, except for local instances."""
+    assert ssl_verify("https://zenodo.org/api") is True
+    assert ssl_verify("https://127.0.0.1:5000/api") is False
+    assert ssl_verify("https://localhost/api") is False
+    assert ssl_verify("https://127.0.0.1:5000/api", True) is True
+    assert ssl_verify("https://zenodo.org/api", "/etc/ca.pem") == "/etc/ca.pem"
+
+
+def test_client_transport():
+    """Test that the client session is sized for the workers, with timeouts."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        CliRunner().invoke(lycophron, ["init"])
+        app = LycophronApp()
+        app.config["ZENODO_URL"] = "https://zenodo.org/api"
+        app.config["CONCURRENCY_LIMITS"] = {"metadata": 8, "files": 5}
+        app.config["FILE_UPLOAD_CONCURRENCY"] = 3
+
+        session = app.client.session
+        assert session.get_adapter("https://zenodo.org")._pool_maxsize == 15
+        assert session.timeout == (10, 120)
+        assert session.verify is True
+
+
+def test_idempotent_requests_retried(server):
+    """Test that GETs are retried on server errors, but not POSTs."""
+    url, httpd = server
+    session = RateLimitedSession(RateLimiter(6000))
+    mount_transport(session, pool_size=2, retries=2, backoff_factor=0)
+
+    assert session.get(f"{url}/record").status_code == 200
+    assert session.post(f"{url}/record").status_code == 503
+    assert httpd.requests == [("GET", "/record")] * 2 + [("POST", "/record")]
+
+
+def test_default_timeout(server):
+    """Test that requests without a timeout get the one of the session."""
+    url, _ = server
+    session = RateLimitedSession(RateLimiter(6000), timeout=(1, 0.1))
+    mount_transport(session, pool_size=2)
+
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        session.post(f"{url}/slow")
+    assert session.post(f"{url}/slow", timeout=5).status_code == 200
+
+
+def test_httpx_transport(server):
+    """Test that the httpx transport retries, times out and falls back."""
+    pytest.importorskip("httpx")
+    from lycophron.transport import HTTPXAdapter, mount_http2_transport
+
+    url, httpd = server
+    session = RateLimitedSession(RateLimiter(6000), timeout=(1, 0.1))
+    adapter = mount_http2_transport(session, pool_size=2, retries=2, backoff_factor=0)
+    assert isinstance(session.get_adapter(url), HTTPXAdapter)
+
+    assert session.get(f"{url}/record").status_code == 200
+    assert session.post(f"{url}/record", json={}).status_code == 503
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        session.post(f"{url}/slow")
+    # Streamed bodies go through the HTTP/1.1 adapter
+    with patch.object(adapter.fallback, "send", wraps=adapter.fallback.send) as send:
+        assert session.post(f"{url}/file", data=io.BytesIO(b"data")).status_code
+    send.assert_called_once()
+    assert httpd.requests[:3] == [("GET", "/record")] * 2 + [("POST", "/record")]
+    session.close()
+
+
+class H2Protocol(asyncio.Protocol):
+    """HTTP/2 server without TLS, answering every request after a delay."""
+
+    def __init__(self, stats):
+        import h2.config
+        import h2.connection
+
+        self.stats = stats
+        self.conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False)
+        )
+
+    def connection_made(self, transport):
+        self.stats["connections"] += 1
+        self.transport = transport
+        self.conn.initiate_connection()
+        transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        import h2.events
+
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                self.stats["in_flight"] += 1
+                self.stats["max_in_flight"] = max(
+                    self.stats["max_in_flight"], self.stats["in_flight"]
+                )
+                asyncio.get_running_loop().call_later(
+                    0.1, self._respond, event.stream_id
+                )
+        self.transport.write(self.conn.data_to_send())
+
+    def _respond(self, stream_id):
+        self.stats["in_flight"] -= 1
+        body = b'{"id": "abcd-1234"}'
+        headers = [(":status", "200"), ("content-length", str(len(body)))]
+        self.conn.send_headers(stream_id, headers)
+        self.conn.send_data(stream_id, body, end_stream=True)
+        self.transport.write(self.conn.data_to_send())
+
+
+def test_httpx_transport_multiplexes(monkeypatch):
+    """Test that concurrent requests share a single HTTP/2 connection."""
+    httpx = pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+    from lycophron import transport
+
+    stats = {"connections": 0, "in_flight": 0, "max_in_flight": 0}
+    loop = asyncio.new_event_loop()
+    h2_server = loop.run_until_complete(
+        loop.create_server(lambda: H2Protocol(stats), "127.0.0.1", 0)
+    )
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    port = h2_server.sockets[0].getsockname()[1]
+    # Without TLS to negotiate it, HTTP/2 is used with prior knowledge
+    monkeypatch.setattr(
+        transport.httpx,
+        "Client",
+        functools.partial(httpx.Client, http1=False),
+    )
+
+    session = RateLimitedSession(RateLimiter(6000), timeout=5)
+    transport.mount_http2_transport(session, pool_size=4)
+    with ThreadPoolExecutor(10) as pool:
+        responses = list(
+            pool.map(
+                lambda i: session.get(f"http://127.0.0.1:{port}/api/records/{i}"),
+                range(10),
+            )
+        )
+    session.close()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    h2_server.close()
+    loop.close()
+
+    assert [r.json() for r in responses] == [{"id": "abcd-1234"}] * 10
+    assert stats["connections"] == 1
+    assert stats["max_in_flight"] > 1
+
+
+def test_client_http_transport():
+    """Test that the HTTP transport of the client is configurable."""
+    pytest.importorskip("httpx")
+    from lycophron.transport import HTTPXAdapter
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        CliRunner().invoke(lycophron, ["init"])
+        app = LycophronApp()
+        app.config["HTTP_TRANSPORT"] = "httpx"
+        assert isinstance(app.client.session.get_adapter("https://x"), HTTPXAdapter)
+        app.client.session.close()
+
+        del app.client
+        app.config["HTTP_TRANSPORT"] = "urllib"
+        with pytest.raises(InvalidConfig):
+            _ = app.client